@@ -0,0 +1,271 @@
+"""
+Архив сырых ответов API: сжатые сегменты JSONL, которые только дописываются.
+
+Каждая страница записывается отдельным gzip-членом (по одной записи API в строке),
+поэтому сегмент целиком читается zcat, а отдельная страница - по смещению и длине
+из индекса. Рядом с сегментом pages-*.jsonl.gz лежит его индекс pages-*.idx (JSONL):
+segment, offset, length, fetched_at, key, count, min_id, max_id.
+
+Записи сжимаются по мере чтения ответа, в памяти остаётся только сжатая страница.
+Сегмент закрывается, когда его размер превышает ARCHIVE_SEGMENT_SIZE; сегменты старше
+ARCHIVE_RETENTION_DAYS дней удаляются вместе с индексом при запуске и затем раз в час.
+
+Команды:
+    python archive.py list [--since ...] [--until ...] [--order-id ...] [--key ...]
+    python archive.py replay [те же фильтры]  - повторная запись страниц в orderstable
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import zlib
+import logging
+import argparse
+import threading
+from pathlib import Path
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", str(64 * 1024 * 1024)))
+ARCHIVE_RETENTION_DAYS = float(os.getenv("ARCHIVE_RETENTION_DAYS", "30"))
+
+SEGMENT_SUFFIX = ".jsonl.gz"
+INDEX_SUFFIX = ".idx"
+RETENTION_CHECK_INTERVAL = 3600
+
+
+class PageWriter:
+    """Страница архива, которая заполняется по одной записи и сжимается на лету."""
+
+    def __init__(self, archive, key):
+        self.archive = archive
+        self.key = key
+        self.count = 0
+        self.min_id = None
+        self.max_id = None
+        # wbits=31 - формат gzip: каждая страница становится отдельным gzip-членом.
+        self._compressor = zlib.compressobj(wbits=31)
+        self._chunks = []
+
+    def add(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        self._chunks.append(self._compressor.compress(line.encode("utf-8")))
+        self.count += 1
+        try:
+            order_id = int(record.get("order_id"))
+        except (TypeError, ValueError, AttributeError):
+            return
+        self.min_id = order_id if self.min_id is None else min(self.min_id, order_id)
+        self.max_id = order_id if self.max_id is None else max(self.max_id, order_id)
+
+    def close(self):
+        """Дописывает страницу в архив. Возвращает запись индекса."""
+        self._chunks.append(self._compressor.flush())
+        return self.archive.write_member(b"".join(self._chunks), self)
+
+
+class ResponseArchive:
+    """Запись страниц ответов API в сегменты архива. Безопасна для нескольких потоков."""
+
+    def __init__(self, directory, segment_size=ARCHIVE_SEGMENT_SIZE, retention_days=ARCHIVE_RETENTION_DAYS):
+        self.directory = Path(directory)
+        self.segment_size = segment_size
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._segment = None
+        self._sequence = 0
+        self._retention_checked = 0.0
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._check_retention()
+
+    def _new_segment(self):
+        self._sequence += 1
+        name = f"pages-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._sequence:04d}"
+        return self.directory / f"{name}{SEGMENT_SUFFIX}"
+
+    def _rotate(self):
+        self._segment = self._new_segment()
+        self._check_retention()
+
+    def _check_retention(self):
+        self._retention_checked = time.monotonic()
+        self.apply_retention()
+
+    def apply_retention(self):
+        """Удаляет сегменты и индексы, которые не менялись дольше срока хранения."""
+        if self.retention_days <= 0:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        for segment in self.directory.glob(f"pages-*{SEGMENT_SUFFIX}"):
+            if segment == self._segment:
+                continue
+            try:
+                if segment.stat().st_mtime < cutoff:
+                    segment.unlink()
+                    index_path(segment).unlink(missing_ok=True)
+                    logger.info(f"Сегмент архива {segment.name} удалён по сроку хранения.")
+            except OSError as e:
+                logger.warning(f"Не удалось удалить сегмент архива {segment}: {e}")
+
+    def page(self, key=None):
+        """Новая страница: записи добавляются через add(), в архив она попадает при close()."""
+        return PageWriter(self, key)
+
+    def append(self, records, key=None):
+        """Дописывает страницу из готового списка записей."""
+        writer = self.page(key)
+        for record in records:
+            writer.add(record)
+        return writer.close()
+
+    def write_member(self, member, page):
+        """Дописывает сжатую страницу в текущий сегмент и её запись в индекс."""
+        with self._lock:
+            if self._segment is None or (self._segment.exists() and self._segment.stat().st_size >= self.segment_size):
+                self._rotate()
+            elif time.monotonic() - self._retention_checked >= RETENTION_CHECK_INTERVAL:
+                self._check_retention()
+
+            with open(self._segment, "ab") as f:
+                offset = f.tell()
+                f.write(member)
+
+            entry = {
+                "segment": self._segment.name,
+                "offset": offset,
+                "length": len(member),
+                "fetched_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "key": page.key,
+                "count": page.count,
+                "min_id": page.min_id,
+                "max_id": page.max_id,
+            }
+            with open(index_path(self._segment), "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
+
+
+def index_path(segment):
+    return segment.with_name(segment.name[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX)
+
+
+def iter_index(directory, since=None, until=None, order_id=None, key=None):
+    """Записи индекса в порядке записи, отобранные по времени, order_id и ключу тела запроса."""
+    for path in sorted(Path(directory).glob(f"pages-*{INDEX_SUFFIX}")):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Строка, недописанная при аварийном завершении.
+                    continue
+                if since and entry["fetched_at"] < since:
+                    continue
+                if until and entry["fetched_at"] > until:
+                    continue
+                if order_id is not None and not (
+                    entry["min_id"] is not None and entry["min_id"] <= order_id <= entry["max_id"]
+                ):
+                    continue
+                if key and key not in (entry.get("key") or ""):
+                    continue
+                yield entry
+
+
+def read_page(directory, entry):
+    """Записи API одной страницы архива."""
+    with open(Path(directory) / entry["segment"], "rb") as f:
+        f.seek(entry["offset"])
+        data = gzip.decompress(f.read(entry["length"]))
+    return [json.loads(line) for line in data.decode("utf-8").splitlines() if line]
+
+
+def replay(directory, entries):
+    """
+    Передаёт страницы архива потоку записи getorders; контрольные точки не меняются.
+
+    Страницы записываются с проверкой updated_at: заказ, уже обновлённый в БД позже
+    архивной версии, не откатывается.
+    Возвращает число записанных страниц или None, если запись невозможна или прервана.
+    """
+    import queue
+    import mysql.connector
+    from db import DB_CONFIG, get_connection
+    from getorders import PIPELINE_QUEUE_SIZE, Page, has_unique_order_key, parse_and_insert, record_to_row
+
+    # Те же проверки, что в parse_and_insert: иначе поток записи завершится сразу, а replay зависнет на очереди.
+    if not all(DB_CONFIG.values()):
+        logger.error("Не все параметры базы данных заданы в переменных окружения.")
+        return None
+    try:
+        with get_connection() as cnx:
+            with cnx.cursor() as cursor:
+                unique_key = has_unique_order_key(cursor)
+    except mysql.connector.Error as err:
+        logger.error(f"Не удалось проверить индексы orderstable: {err}")
+        return None
+    if not unique_key:
+        logger.error("В orderstable нет уникального индекса по partner_order_id. Выполните orderstable_unique.sql.")
+        return None
+
+    pages = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    writer = threading.Thread(target=parse_and_insert, args=(pages,), daemon=True)
+    writer.start()
+
+    replayed = 0
+    for entry in entries:
+        rows = [row for row in map(record_to_row, read_page(directory, entry)) if row is not None]
+        page = Page(rows, {}, guarded=True)
+        while True:
+            try:
+                pages.put(page, timeout=1)
+                break
+            except queue.Full:
+                if not writer.is_alive():
+                    logger.error("Поток записи остановлен, повторная запись прервана.")
+                    return None
+        replayed += 1
+
+    while pages.unfinished_tasks:
+        if not writer.is_alive():
+            logger.error("Поток записи остановлен, повторная запись прервана.")
+            return None
+        time.sleep(1)
+    return replayed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Архив ответов API: просмотр и повторная запись страниц.")
+    parser.add_argument("command", choices=("list", "replay"))
+    parser.add_argument("--dir", default=ARCHIVE_DIR, help="каталог архива (по умолчанию ARCHIVE_DIR)")
+    parser.add_argument("--since", help="не раньше, 'YYYY-MM-DD HH:MM:SS'")
+    parser.add_argument("--until", help="не позже, 'YYYY-MM-DD HH:MM:SS'")
+    parser.add_argument("--order-id", type=int, help="страницы, в диапазон order_id которых попадает заказ")
+    parser.add_argument("--key", help="подстрока ключа тела запроса")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    if not args.dir:
+        logging.error("Не задан каталог архива (ARCHIVE_DIR или --dir).")
+        return
+
+    entries = iter_index(args.dir, args.since, args.until, args.order_id, args.key)
+    if args.command == "list":
+        for entry in entries:
+            print(json.dumps(entry, ensure_ascii=False))
+    else:
+        replayed = replay(args.dir, entries)
+        if replayed is None:
+            sys.exit(1)
+        logging.info(f"Повторно записано страниц: {replayed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Массовая загрузка выгрузок заказов (JSON-массив или JSONL, можно .gz) в orderstable.
+
+Записи разбираются тем же соответствием полей, что и в getorders (record_to_row),
+складываются во временную таблицу orders_staging (LOAD DATA LOCAL INFILE через
+orders_raw или многострочные INSERT), затем одним INSERT ... SELECT ... ON DUPLICATE KEY UPDATE
+переносятся в orderstable. И в orders_staging, и в orderstable остаётся версия заказа
+с наибольшим updated_at, а не последняя по порядку в файлах. Триггеры customers на время переноса отключены
+(@orders_bulk_ingest), затронутые клиенты пересчитываются один раз в конце.
+"""
+import os
+import gzip
+import json
+import logging
+import argparse
+import tempfile
+
+import mysql.connector
+
+from db import DB_CONFIG
+from getorders import (
+    JSON_ERRORS,
+    ORDER_COLUMNS,
+    UPSERT_ROW_PLACEHOLDER,
+    bulk_ingest,
+    chunked,
+    guarded_upsert_tail,
+    has_unique_order_key,
+    ijson,
+    record_to_row,
+    refresh_customers,
+)
+
+STAGING_TABLE = "orders_staging"
+# Таблица без индексов для LOAD DATA: повторы заказа в ней сводятся в orders_staging по updated_at.
+RAW_TABLE = "orders_raw"
+COLUMNS = ", ".join(ORDER_COLUMNS)
+
+STAGING_INSERT_HEAD = f"INSERT INTO {STAGING_TABLE} ({COLUMNS}) VALUES "
+# Повтор заказа в выгрузке заменяет версию с меньшим или равным updated_at.
+STAGING_INSERT_TAIL = guarded_upsert_tail(STAGING_TABLE)
+
+RAW_MERGE_QUERY = f"INSERT INTO {STAGING_TABLE} ({COLUMNS}) SELECT {COLUMNS} FROM {RAW_TABLE}" + STAGING_INSERT_TAIL
+
+# Строки orderstable, обновлённые позже выгрузки, не перезаписываются.
+MERGE_QUERY = f"INSERT INTO orderstable ({COLUMNS}) SELECT {COLUMNS} FROM {STAGING_TABLE}" + guarded_upsert_tail("orderstable")
+
+# Временную таблицу MySQL нельзя прочитать в одном запросе дважды (ошибка 1137 "Can't reopen table"),
+# поэтому прежний и новый customer_code берутся одним LEFT JOIN, а множество собирается в Python.
+TOUCHED_CUSTOMERS_QUERY = f"""
+SELECT DISTINCT s.customer_code, o.customer_code
+FROM {STAGING_TABLE} s
+LEFT JOIN orderstable o ON o.partner_order_id = s.partner_order_id
+"""
+
+
+def open_dump(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def iter_dump(path, fmt):
+    """Записи API из файла выгрузки: JSON-массив или по одной записи JSON в строке."""
+    if fmt == "auto":
+        fmt = "jsonl" if ".jsonl" in path or ".ndjson" in path else "json"
+
+    with open_dump(path) as f:
+        if fmt == "jsonl":
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        elif ijson is not None:
+            yield from ijson.items(f, "item", use_float=True)
+        else:
+            yield from json.load(f)
+
+
+def iter_rows(paths, fmt):
+    """Строки OrderRow из всех файлов; записи без order_id пропускаются."""
+    for path in paths:
+        logging.info(f"Чтение {path}...")
+        for record in iter_dump(path, fmt):
+            row = record_to_row(record)
+            if row is not None:
+                yield row
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tsv_value(value):
+    """Значение в формате LOAD DATA по умолчанию: \\N для NULL, экранирование обратной косой чертой."""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def stage_load(cursor, rows):
+    """Записывает пачку в orders_staging через временный файл, LOAD DATA LOCAL INFILE и orders_raw."""
+    fd, tmp_name = tempfile.mkstemp(prefix="backfill-", suffix=".tsv")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="\n") as f:
+            for row in rows:
+                f.write("\t".join(tsv_value(value) for value in row))
+                f.write("\n")
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {RAW_TABLE} CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({COLUMNS})",
+            (tmp_name,)
+        )
+    finally:
+        os.remove(tmp_name)
+    cursor.execute(RAW_MERGE_QUERY)
+    cursor.execute(f"DELETE FROM {RAW_TABLE}")
+
+
+def stage_insert(cursor, rows, chunk_size):
+    """Записывает пачку в orders_staging многострочными INSERT."""
+    for chunk in chunked(rows, chunk_size):
+        query = STAGING_INSERT_HEAD + ", ".join([UPSERT_ROW_PLACEHOLDER] * len(chunk)) + STAGING_INSERT_TAIL
+        cursor.execute(query, [value for row in chunk for value in row])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовая загрузка выгрузок заказов в orderstable.")
+    parser.add_argument("files", nargs="+", help="файлы выгрузки (.json, .jsonl, можно .gz)")
+    parser.add_argument("--format", choices=("auto", "json", "jsonl"), default="auto", help="формат файлов")
+    parser.add_argument("--method", choices=("load", "insert"), default="load",
+                        help="load - LOAD DATA LOCAL INFILE (нужен local_infile на сервере), insert - многострочные INSERT")
+    parser.add_argument("--batch-size", type=int, default=50000, help="строк на одну загрузку в orders_staging")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="строк в одном INSERT при --method insert")
+    parser.add_argument("--dry-run", action="store_true", help="только разобрать файлы и посчитать заказы")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    rows = iter_rows(args.files, args.format)
+
+    if args.dry_run:
+        try:
+            count = sum(1 for _ in rows)
+        except JSON_ERRORS as e:
+            logging.error(f"Ошибка разбора выгрузки: {e}")
+            return
+        logging.info(f"Заказов в выгрузке: {count}")
+        return
+
+    if not all(DB_CONFIG.values()):
+        logging.error("Не все параметры базы данных заданы в переменных окружения.")
+        return
+
+    # Отдельное соединение вне пула: временная таблица живёт в пределах сессии,
+    # а LOAD DATA LOCAL требует allow_local_infile.
+    cnx = mysql.connector.connect(**DB_CONFIG, allow_local_infile=args.method == "load")
+    try:
+        cursor = cnx.cursor()
+        if not has_unique_order_key(cursor):
+            logging.error("В orderstable нет уникального индекса по partner_order_id. Выполните orderstable_unique.sql.")
+            return
+        cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {STAGING_TABLE}")
+        cursor.execute(f"CREATE TEMPORARY TABLE {STAGING_TABLE} LIKE orderstable")
+        if args.method == "load":
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {RAW_TABLE}")
+            cursor.execute(f"CREATE TEMPORARY TABLE {RAW_TABLE} SELECT {COLUMNS} FROM orderstable LIMIT 0")
+
+        staged = 0
+        try:
+            for batch in batched(rows, args.batch_size):
+                if args.method == "load":
+                    stage_load(cursor, batch)
+                else:
+                    stage_insert(cursor, batch, args.chunk_size)
+                cnx.commit()
+                staged += len(batch)
+                logging.info(f"Загружено в {STAGING_TABLE}: {staged}")
+        except JSON_ERRORS as e:
+            logging.error(f"Ошибка разбора выгрузки после {staged} заказов: {e}. Перенос в orderstable отменён.")
+            return
+
+        cursor.execute(f"SELECT COUNT(*) FROM {STAGING_TABLE}")
+        unique_orders = cursor.fetchone()[0]
+        logging.info(f"Уникальных заказов в {STAGING_TABLE}: {unique_orders}. Перенос в orderstable...")
+
+        with bulk_ingest(cursor):
+            cursor.execute(TOUCHED_CUSTOMERS_QUERY)
+            touched_customers = {code for codes in cursor.fetchall() for code in codes if code is not None}
+
+            cursor.execute(MERGE_QUERY)
+            affected = cursor.rowcount
+
+            logging.info(f"Пересчёт customers для {len(touched_customers)} клиентов...")
+            refresh_customers(cursor, touched_customers, chunk_size=args.chunk_size)
+            cnx.commit()
+
+        cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {STAGING_TABLE}")
+        cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {RAW_TABLE}")
+        cursor.close()
+        # ON DUPLICATE KEY UPDATE считает вставку за 1, изменённую строку за 2, неизменную за 0.
+        logging.info(f"Перенос завершён. Заказов: {unique_orders}, затронуто строк (по счёту MySQL): {affected}")
+    except mysql.connector.Error as err:
+        cnx.rollback()
+        logging.error(f"Ошибка при работе с базой данных: {err}")
+    finally:
+        cnx.close()
+
+
+if __name__ == "__main__":
+    main()
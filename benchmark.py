@@ -0,0 +1,472 @@
+"""
+Замер пропускной способности getorders и getdocs на синтетических данных.
+
+Поднимает локальную замену LOGIN_URL, API_URL и ссылок на квитанции с настраиваемой
+задержкой и долей ошибок, прогоняет через неё загрузку заказов и скачивание квитанций
+и сохраняет результаты в JSON, чтобы сравнивать версии между собой.
+
+Запись в БД замеряется только с флагом --db: все изменения делаются в транзакции,
+которая в конце откатывается.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import bisect
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Логи, токен и квитанции замера пишутся во временный каталог, а не в рабочие файлы.
+WORK_DIR = Path(tempfile.mkdtemp(prefix="orderscontrol-bench-"))
+os.environ["LOG_FILE1"] = str(WORK_DIR / "getorders.log")
+os.environ["LOG_FILE2"] = str(WORK_DIR / "getdocs.log")
+os.environ["BASE_DIR"] = str(WORK_DIR / "receipts")
+os.environ.pop("BLOB_DIR", None)
+
+import requests
+import mysql.connector
+
+import getdocs
+import getorders
+from db import DB_CONFIG, get_connection
+
+BENCH_TOKEN = "benchmark-token"
+RECEIPT_BLOCK = os.urandom(64 * 1024)
+# Столько ошибок подряд при загрузке страниц - и замер останавливается.
+MAX_ERRORS_IN_ROW = 10
+
+
+class OrderGenerator:
+    """Синтетические заказы в формате ответа API (как их ждёт record_to_row)."""
+
+    def __init__(self, base_url, customers=1000, record_size=0, seed=0):
+        self.base_url = base_url
+        self.customers = customers
+        self.record_size = record_size
+        self.random = random.Random(seed)
+        self.start = datetime(2025, 1, 1)
+
+    def _timestamp(self, moment):
+        return moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    def make(self, order_id):
+        created_at = self.start + timedelta(seconds=order_id % 10000000)
+        return {
+            "order_id": order_id,
+            "internal_id": f"tr-{order_id}",
+            "order_status": self.random.choice((0, 1, 1, 1, 2)),
+            "customer_code": f"bench-{self.random.randrange(self.customers)}",
+            "aboutorder_info1": "info1",
+            "aboutorder_info2": "info2",
+            "aboutorder_info3": "info3",
+            "aboutorder_info4": "info4",
+            "aboutorder_info5": "x" * self.record_size,
+            "additional_info": {
+                "document_url": f"{self.base_url}/receipts/{order_id}.pdf",
+                "aboutorder_info6": "info6",
+                "aboutorder_info7": "info7",
+            },
+            "partner": {
+                "internal_id": self.random.randrange(1, 50),
+                "aboutpartner_info1": "partner1",
+                "aboutpartner_info2": "partner2",
+                "aboutpartner_info3": "partner3",
+            },
+            "payment_details": {
+                "internal_id": self.random.randrange(1, 10),
+                "aboutpayment_info1": "payment1",
+                "aboutpayment_info2": "payment2",
+            },
+            "created_at": self._timestamp(created_at),
+            "updated_at": self._timestamp(created_at),
+            "payment_amount": f"{self.random.uniform(100, 100000):.2f}",
+            "responsible_user": {"username": "bench"},
+        }
+
+    def mutate(self, record):
+        """Новая версия заказа: меняются статус, сумма и updated_at."""
+        record = dict(record)
+        record["order_status"] = self.random.choice((0, 1, 2))
+        record["payment_amount"] = f"{self.random.uniform(100, 100000):.2f}"
+        record["updated_at"] = self._timestamp(datetime.now(timezone.utc))
+        return record
+
+
+class StandIn:
+    """Состояние локальной замены API: заказы, задержка, ошибки и счётчики."""
+
+    def __init__(self, orders, latency=0.0, error_rate=0.0, change_rate=0.0, receipt_size=200 * 1024, seed=0):
+        self.records = {}
+        self.ids = []
+        self.latency = latency
+        self.error_rate = error_rate
+        self.change_rate = change_rate
+        self.receipt_size = receipt_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.generator = None
+        self.requests = 0
+        self.errors = 0
+        self.orders = orders
+
+    def fill(self, generator, start_id):
+        self.generator = generator
+        self.ids = list(range(start_id, start_id + self.orders))
+        self.records = {order_id: generator.make(order_id) for order_id in self.ids}
+
+    def should_fail(self):
+        with self.lock:
+            self.requests += 1
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def page(self, limit):
+        """Страница заказов по курсору last_id, как её отдаёт API."""
+        last_id = int(limit.get("last_id") or 0)
+        max_results = int(limit.get("max_results") or 512)
+        with self.lock:
+            if limit.get("descending", True):
+                end = bisect.bisect_left(self.ids, last_id) if last_id else len(self.ids)
+                ids = self.ids[max(0, end - max_results):end][::-1]
+            else:
+                start = bisect.bisect_right(self.ids, last_id)
+                ids = self.ids[start:start + max_results]
+
+            for order_id in ids:
+                if self.random.random() < self.change_rate:
+                    self.records[order_id] = self.generator.mutate(self.records[order_id])
+            return [self.records[order_id] for order_id in ids]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _inject(self):
+        """Задержка и случайная ошибка 503. Возвращает True, если ответ уже отправлен."""
+        state = self.server.state
+        if state.latency:
+            time.sleep(state.latency)
+        if state.should_fail():
+            self._send(503, b'{"error": "unavailable"}', headers={"Retry-After": "1"})
+            return True
+        return False
+
+    def do_POST(self):
+        state = self.server.state
+        payload = self._read_json()
+        if self._inject():
+            return
+
+        if self.path == "/login":
+            body = {"access_token": BENCH_TOKEN, "expires_in": 3600}
+            self._send(200, json.dumps(body).encode("utf-8"))
+        elif self.path == "/api":
+            if self.headers.get("Authorization") != f"Bearer {BENCH_TOKEN}":
+                self._send(401, b'{"error": "unauthorized"}')
+                return
+            records = state.page(payload.get("limit", {}))
+            self._send(200, json.dumps(records, ensure_ascii=False).encode("utf-8"))
+        else:
+            self._send(404)
+
+    def do_GET(self):
+        state = self.server.state
+        if not self.path.startswith("/receipts/"):
+            self._send(404)
+            return
+        if self._inject():
+            return
+
+        # Начало файла у каждой квитанции своё, чтобы MD5 не совпадали.
+        prefix = self.path.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(state.receipt_size))
+        self.end_headers()
+        remaining = state.receipt_size
+        chunk = prefix[:remaining]
+        while remaining > 0:
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+            chunk = RECEIPT_BLOCK[:remaining]
+
+
+def start_stand_in(state, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, name="stand-in", daemon=True).start()
+    return server
+
+
+def rate(count, seconds):
+    return round(count / seconds, 2) if seconds > 0 else None
+
+
+def bench_fetch(page_size, max_pages):
+    """Загрузка страниц заказов через post_api и read_rows по курсору от старых к новым."""
+    session = getorders.create_session()
+    tokens = getorders.TokenManager(session)
+    body = {"filter": {}, "sort": {}, "limit": {"last_id": 0, "max_results": page_size, "descending": False}}
+
+    pages = []
+    errors = 0
+    failed_in_row = 0
+    orders = 0
+    started = time.perf_counter()
+    while len(pages) < max_pages and failed_in_row < MAX_ERRORS_IN_ROW:
+        try:
+            response = getorders.post_api(session, tokens, body)
+            if response is None:
+                errors += 1
+                failed_in_row += 1
+                continue
+            with response:
+                response.raise_for_status()
+                rows, received = getorders.read_rows(response)
+        except requests.RequestException:
+            errors += 1
+            failed_in_row += 1
+            continue
+        failed_in_row = 0
+
+        if rows:
+            pages.append(rows)
+            orders += len(rows)
+            body["limit"]["last_id"] = max(int(row.partner_order_id) for row in rows)
+        if received < page_size:
+            break
+    seconds = time.perf_counter() - started
+    session.close()
+
+    result = {
+        "pages": len(pages),
+        "orders": orders,
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "orders_per_sec": rate(orders, seconds),
+    }
+    return result, pages
+
+
+def changed_rows(pages, change_rate, seed):
+    """Новые версии части строк для замера обновлений."""
+    rnd = random.Random(seed)
+    changed = []
+    for rows in pages:
+        changed.append([
+            row._replace(status=rnd.choice((0, 1, 2)), payment_amount=round(rnd.uniform(100, 100000), 2),
+                         updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            for row in rows if rnd.random() < change_rate
+        ])
+    return changed
+
+
+def bench_write(pages, updates, mode):
+    """
+    Запись страниц в orderstable в режиме trigger или batch.
+
+    Всё выполняется в одной транзакции, которая в конце откатывается.
+    """
+    inserted = sum(len(rows) for rows in pages)
+    updated = sum(len(rows) for rows in updates)
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            try:
+                timings = {}
+                for name, batches in (("insert", pages), ("update", updates)):
+                    started = time.perf_counter()
+                    for rows in batches:
+                        if not rows:
+                            continue
+                        if mode == "batch":
+                            with getorders.bulk_ingest(cursor):
+                                touched_customers = set()
+                                getorders.upsert_orders(cursor, rows, touched_customers=touched_customers)
+                                getorders.refresh_customers(cursor, touched_customers)
+                        else:
+                            getorders.upsert_orders(cursor, rows)
+                    timings[name] = time.perf_counter() - started
+            finally:
+                conn.rollback()
+
+    seconds = timings["insert"] + timings["update"]
+    return {
+        "inserted": inserted,
+        "updated": updated,
+        "insert_seconds": round(timings["insert"], 3),
+        "update_seconds": round(timings["update"], 3),
+        "seconds": round(seconds, 3),
+        "orders_per_sec": rate(inserted + updated, seconds),
+    }
+
+
+def bench_receipts(base_url, count):
+    """Скачивание квитанций через getdocs.fetch_receipt без записи в БД."""
+    folder = getdocs.BASE_DIR / "bench_receipts"
+    errors = 0
+    total_bytes = 0
+    done = 0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=getdocs.DOWNLOAD_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(getdocs.fetch_receipt, f"{base_url}/receipts/{i}.pdf", folder / f"{i}_receipt.pdf")
+            for i in range(count)
+        ]
+        for future in as_completed(futures):
+            try:
+                receipt_path, _ = future.result()
+                total_bytes += receipt_path.stat().st_size
+                done += 1
+            except (requests.RequestException, OSError):
+                errors += 1
+    seconds = time.perf_counter() - started
+
+    return {
+        "receipts": done,
+        "errors": errors,
+        "bytes": total_bytes,
+        "seconds": round(seconds, 3),
+        "receipts_per_sec": rate(done, seconds),
+        "mb_per_sec": rate(total_bytes / (1024 * 1024), seconds),
+        "storage": getdocs.RECEIPT_STORAGE,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file):
+    """Печатает отношение показателей к результатам предыдущего замера."""
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    for section, metrics in results["results"].items():
+        previous = baseline.get("results", {}).get(section, {})
+        for metric in ("orders_per_sec", "receipts_per_sec", "mb_per_sec"):
+            if metrics.get(metric) and previous.get(metric):
+                ratio = metrics[metric] / previous[metric]
+                logging.info(f"{section}.{metric}: {previous[metric]} -> {metrics[metric]} ({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер пропускной способности загрузки заказов и квитанций.")
+    parser.add_argument("--orders", type=int, default=20000, help="число синтетических заказов")
+    parser.add_argument("--page-size", type=int, default=512, help="заказов на страницу API")
+    parser.add_argument("--max-pages", type=int, default=1000, help="не больше страниц за замер")
+    parser.add_argument("--customers", type=int, default=1000, help="число различных клиентов")
+    parser.add_argument("--record-size", type=int, default=0, help="дополнительных байт в каждой записи")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="доля заказов, меняющихся между запросами")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа замены API, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--receipts", type=int, default=500, help="число квитанций для скачивания")
+    parser.add_argument("--receipt-size", type=int, default=200 * 1024, help="размер квитанции, байт")
+    parser.add_argument("--start-id", type=int, default=900000000, help="первый partner_order_id синтетических заказов")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", action="store_true", help="замерить запись в БД и накладные расходы триггеров (с откатом)")
+    parser.add_argument("--output", default="benchmark_results.json", help="файл для результатов")
+    parser.add_argument("--baseline", help="предыдущий файл результатов для сравнения")
+    parser.add_argument("--keep-files", action="store_true", help="не удалять временный каталог")
+    args = parser.parse_args()
+
+    state = StandIn(args.orders, args.latency / 1000, args.error_rate, args.change_rate, args.receipt_size, args.seed)
+    server = start_stand_in(state)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    state.fill(OrderGenerator(base_url, args.customers, args.record_size, args.seed), args.start_id)
+
+    getorders.LOGIN_URL = f"{base_url}/login"
+    getorders.API_URL = f"{base_url}/api"
+    getorders.TOKEN_FILE = str(WORK_DIR / "token.json")
+
+    results = {
+        "started_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "ijson": getorders.ijson is not None,
+        "params": vars(args),
+        "results": {},
+    }
+
+    try:
+        logging.info("Замер загрузки заказов...")
+        results["results"]["ingest_fetch"], pages = bench_fetch(args.page_size, args.max_pages)
+
+        if args.db:
+            if not all(DB_CONFIG.values()):
+                logging.error("Не все параметры базы данных заданы в переменных окружения, замер записи пропущен.")
+            else:
+                updates = changed_rows(pages, args.change_rate, args.seed)
+                try:
+                    logging.info("Замер записи в БД с пересчётом customers в триггерах...")
+                    trigger = bench_write(pages, updates, "trigger")
+                    logging.info("Замер записи в БД в пакетном режиме...")
+                    batch = bench_write(pages, updates, "batch")
+                    results["results"]["ingest_write_trigger"] = trigger
+                    results["results"]["ingest_write_batch"] = batch
+                    results["results"]["trigger_overhead"] = {
+                        "trigger_seconds": trigger["seconds"],
+                        "batch_seconds": batch["seconds"],
+                        "ratio": round(trigger["seconds"] / batch["seconds"], 3) if batch["seconds"] else None,
+                    }
+                except mysql.connector.Error as err:
+                    logging.error(f"Ошибка при замере записи в БД: {err}")
+
+        if args.receipts:
+            logging.info("Замер скачивания квитанций...")
+            results["results"]["receipts"] = bench_receipts(base_url, args.receipts)
+
+        results["results"]["stand_in"] = {"requests": state.requests, "injected_errors": state.errors}
+    finally:
+        server.shutdown()
+        if not args.keep_files:
+            shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    for section, metrics in results["results"].items():
+        logging.info(f"{section}: {json.dumps(metrics, ensure_ascii=False)}")
+    logging.info(f"Результаты сохранены в {args.output}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
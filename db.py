@@ -0,0 +1,92 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import mysql.connector
+import mysql.connector.pooling
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST"),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+    "database": os.getenv("DB_DATABASE"),
+    "port": int(os.getenv("DB_PORT", "3306")),
+}
+
+# mysql-connector ограничивает размер пула 32 соединениями.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Пул соединений процесса, создаётся при первом обращении."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name="orderscontrol",
+                pool_size=DB_POOL_SIZE,
+                pool_reset_session=True,
+                **DB_CONFIG
+            )
+        return _pool
+
+
+def _acquire():
+    """Берёт соединение из пула, при исчерпании пула ждёт до DB_POOL_TIMEOUT секунд."""
+    pool = get_pool()
+    deadline = time.monotonic() + DB_POOL_TIMEOUT
+    while True:
+        try:
+            cnx = pool.get_connection()
+            break
+        except mysql.connector.errors.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+    try:
+        # Соединение могло быть закрыто сервером, пока лежало в пуле.
+        cnx.ping(reconnect=True, attempts=3, delay=1)
+    except mysql.connector.Error:
+        _release(cnx)
+        raise
+    return cnx
+
+
+def _release(cnx):
+    try:
+        cnx.close()
+    except mysql.connector.Error as err:
+        logger.warning(f"Не удалось вернуть соединение в пул: {err}")
+
+
+@contextmanager
+def get_connection():
+    """
+    Соединение из общего пула на время блока with.
+
+    Незафиксированная транзакция при ошибке откатывается, после блока
+    соединение возвращается в пул.
+    """
+    cnx = _acquire()
+    try:
+        yield cnx
+    except BaseException:
+        try:
+            cnx.rollback()
+        except mysql.connector.Error:
+            pass
+        raise
+    finally:
+        _release(cnx)
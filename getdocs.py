@@ -1,5 +1,6 @@
 import os
 import requests
+import requests.adapters
 import mysql.connector
 from pathlib import Path
 import logging
@@ -9,8 +10,16 @@ from urllib.parse import urlparse
 import time
 import threading
 import hashlib
+import random
+import socket
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 
+import metrics
+from polling import AdaptivePoller
+from db import get_connection
+
 load_dotenv()
 
 LOG_FILE = os.getenv("LOG_FILE2")
@@ -32,18 +41,70 @@ rotating_handler.setFormatter(log_formatter)
 
 logger.addHandler(rotating_handler)
 
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST"),
-    "user": os.getenv("DB_USER"),
-    "password": os.getenv("DB_PASSWORD"),
-    "database": os.getenv("DB_DATABASE"),
-    "port": int(os.getenv("DB_PORT"))
-}
-
 BASE_DIR = Path(os.getenv("BASE_DIR"))
 
-failed_downloads = set()
-failed_downloads_lock = threading.Lock()
+# plain - файлы по заказам в {customer_code}_receipts;
+# cas - файлы по MD5 в BLOB_DIR, в каталогах заказов жёсткие ссылки на них.
+RECEIPT_STORAGE = os.getenv("RECEIPT_STORAGE", "plain")
+RECEIPT_HARDLINKS = os.getenv("RECEIPT_HARDLINKS", "1") == "1"
+BLOB_DIR = Path(os.getenv("BLOB_DIR") or BASE_DIR / "blobs")
+BLOB_TMP_DIR = BLOB_DIR / "tmp"
+
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+DOWNLOAD_PER_HOST = int(os.getenv("DOWNLOAD_PER_HOST", "4"))
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "30"))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+PENDING_BATCH_SIZE = int(os.getenv("PENDING_BATCH_SIZE", "500"))
+
+# Несколько экземпляров getdocs делят очередь pendingdocs: каждый забирает пачку
+# с арендой на LEASE_SECONDS секунд, аренды упавших экземпляров истекают и забираются заново.
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "900"))
+# Пачка аренды не больше CLAIM_PER_WORKER строк на поток загрузки: иначе хвост пачки
+# ждёт в пуле дольше LEASE_SECONDS, и аренда истекает до начала скачивания.
+CLAIM_PER_WORKER = int(os.getenv("CLAIM_PER_WORKER", "4"))
+CLAIM_BATCH_SIZE = max(1, min(PENDING_BATCH_SIZE, DOWNLOAD_CONCURRENCY * CLAIM_PER_WORKER))
+
+# Повторные попытки: задержка растёт экспоненциально от RETRY_BASE_DELAY до RETRY_MAX_DELAY
+# со случайным разбросом, после RETRY_MAX_ATTEMPTS попыток заказ переводится в состояние dead.
+RETRY_BASE_DELAY = int(os.getenv("RETRY_BASE_DELAY", "60"))
+RETRY_MAX_DELAY = int(os.getenv("RETRY_MAX_DELAY", "21600"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "10"))
+# После BREAKER_THRESHOLD подряд сетевых ошибок хост отключается на BREAKER_COOLDOWN секунд.
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", "300"))
+
+# Порт HTTP-сервера метрик (0 - не запускать).
+METRICS_PORT = int(os.getenv("METRICS_PORT2", "0"))
+
+DOWNLOAD_SECONDS = metrics.histogram("receipts_download_seconds", "Время скачивания и сохранения квитанции.", ["result"])
+DOWNLOADED_BYTES = metrics.counter("receipts_downloaded_bytes_total", "Скачано байт квитанций.")
+DOWNLOADS = metrics.counter("receipts_downloads_total", "Загрузки квитанций по результату (ok, retry, dead, postponed).", ["result"])
+BREAKER_TRIPS = metrics.counter("receipts_breaker_trips_total", "Отключения хоста после серии сетевых ошибок.", ["host"])
+CLAIM_SECONDS = metrics.histogram("receipts_claim_seconds", "Время получения пачки из pendingdocs.", ["queue"])
+CLAIMED_ROWS = metrics.counter("receipts_claimed_total", "Строки pendingdocs, взятые в аренду.", ["queue"])
+IN_FLIGHT = metrics.gauge("receipts_in_flight", "Квитанции, которые сейчас скачиваются.")
+
+host_breakers = {}
+host_breakers_lock = threading.Lock()
+
+# Общий для обоих потоков пул загрузок: DOWNLOAD_CONCURRENCY ограничивает
+# число одновременных скачиваний во всём процессе.
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix="Загрузка")
+
+http_session = requests.Session()
+http_adapter = requests.adapters.HTTPAdapter(pool_connections=DOWNLOAD_CONCURRENCY, pool_maxsize=DOWNLOAD_PER_HOST)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+host_slots = {}
+host_slots_lock = threading.Lock()
+
+in_flight = set()
+in_flight_lock = threading.Lock()
+
+# Пока в pendingdocs находятся квитанции к загрузке, проверки идут с минимальным интервалом.
+poller = AdaptivePoller()
 
 def calculate_md5(filepath):
     """Вычисляет MD5 хэш файла."""
@@ -73,86 +134,375 @@ def get_file_extension(url):
     return ext if ext else ".dat"
 
 
-def download_kvit(transaction_id, partner_order_id, customer_code, document_url, cnx):
-    user_folder = BASE_DIR / f"{customer_code}_receipts"
-    user_folder.mkdir(exist_ok=True)
+def save_response(response, directory, filename):
+    """
+    Потоково сохраняет тело ответа во временный файл в directory.
+
+    Возвращает (путь временного файла, MD5 хэш). Если получено меньше байт,
+    чем указано в Content-Length, временный файл удаляется.
+    """
+    hash_md5 = hashlib.md5()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{filename}.", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                hash_md5.update(chunk)
+
+        expected_length = response.headers.get("Content-Length")
+        # tell() считает байты, полученные из сети, до распаковки Content-Encoding.
+        received_length = response.raw.tell()
+        if expected_length is not None and received_length != int(expected_length):
+            raise IOError(f"Ответ обрезан: получено {received_length} из {expected_length} байт")
+
+        os.chmod(tmp_path, 0o644)
+    except BaseException:
+        discard_file(tmp_path)
+        raise
+    return Path(tmp_path), hash_md5.hexdigest()
+
+def discard_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def blob_path(md5_hash, extension):
+    """Путь к файлу в хранилище, адресуемом по содержимому: blobs/ab/cd/abcd...ext."""
+    return BLOB_DIR / md5_hash[:2] / md5_hash[2:4] / f"{md5_hash}{extension}"
+
+def store_blob(tmp_path, md5_hash, extension):
+    """Переносит файл в хранилище по хэшу; если такой файл уже есть, дубликат удаляется."""
+    blob = blob_path(md5_hash, extension)
+    if blob.exists():
+        discard_file(tmp_path)
+    else:
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, blob)
+    return blob
+
+def link_receipt(blob, filepath):
+    """Атомарно заменяет filepath жёсткой ссылкой на blob."""
+    tmp_link = filepath.with_name(f".{filepath.name}.link")
+    discard_file(tmp_link)
+    os.link(blob, tmp_link)
+    os.replace(tmp_link, filepath)
+
+def place_receipt(tmp_path, md5_hash, filepath):
+    """Размещает скачанный файл и возвращает путь для orderdocstable."""
+    if RECEIPT_STORAGE != "cas":
+        os.replace(tmp_path, filepath)
+        return filepath
+
+    blob = store_blob(tmp_path, md5_hash, filepath.suffix)
+    if RECEIPT_HARDLINKS:
+        try:
+            filepath.parent.mkdir(exist_ok=True)
+            link_receipt(blob, filepath)
+            return filepath
+        except OSError as e:
+            logger.warning(f"Не удалось создать жёсткую ссылку {filepath} на {blob}: {e}. В БД будет записан путь в хранилище.")
+    return blob
+
+def host_slot(url):
+    """Семафор, ограничивающий число одновременных загрузок с одного хоста."""
+    host = urlparse(url).netloc
+    with host_slots_lock:
+        if host not in host_slots:
+            host_slots[host] = threading.BoundedSemaphore(DOWNLOAD_PER_HOST)
+        return host_slots[host]
+
+def retry_delay(attempts):
+    """Задержка перед попыткой номер attempts + 1: экспонента с разбросом ±50%."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0))
+    return int(delay * random.uniform(0.5, 1.5))
+
+def breaker_open_until(url):
+    """Время, до которого загрузки с хоста приостановлены, или None."""
+    host = urlparse(url).netloc
+    with host_breakers_lock:
+        breaker = host_breakers.get(host)
+        if breaker and breaker["open_until"] > time.time():
+            return breaker["open_until"]
+    return None
+
+def record_host_result(url, success):
+    host = urlparse(url).netloc
+    with host_breakers_lock:
+        breaker = host_breakers.setdefault(host, {"failures": 0, "open_until": 0})
+        if success:
+            breaker["failures"] = 0
+            return
+        breaker["failures"] += 1
+        if breaker["failures"] >= BREAKER_THRESHOLD:
+            breaker["open_until"] = time.time() + BREAKER_COOLDOWN
+            breaker["failures"] = 0
+            BREAKER_TRIPS.inc(host=host)
+            logger.warning(f"Хост {host} недоступен, загрузки с него приостановлены на {BREAKER_COOLDOWN} секунд.")
+
+def is_host_failure(error):
+    """Ошибка говорит о проблеме хоста, а не конкретной ссылки (например, 404)."""
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, requests.RequestException)
+
+def schedule_retry(partner_order_id, attempts, error):
+    """Откладывает заказ в pendingdocs до следующей попытки. Возвращает True, если попытки исчерпаны."""
+    attempts += 1
+    dead = attempts >= RETRY_MAX_ATTEMPTS
+    with get_connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute(
+            """
+            UPDATE pendingdocs
+            SET attempts = %s,
+                next_attempt_at = NOW() + INTERVAL %s SECOND,
+                last_error = %s,
+                state = %s,
+                lease_owner = NULL,
+                lease_expires_at = NULL
+            WHERE partner_order_id = %s AND lease_owner = %s
+            """,
+            (attempts, retry_delay(attempts), str(error)[:1024], "dead" if dead else "pending", partner_order_id, WORKER_ID)
+        )
+        cnx.commit()
+        cursor.close()
+    return dead
+
+def postpone(partner_order_id, until):
+    """Переносит попытку без её учёта (хост временно отключён)."""
+    with get_connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute(
+            """
+            UPDATE pendingdocs
+            SET next_attempt_at = FROM_UNIXTIME(%s), lease_owner = NULL, lease_expires_at = NULL
+            WHERE partner_order_id = %s AND lease_owner = %s
+            """,
+            (int(until), partner_order_id, WORKER_ID)
+        )
+        cnx.commit()
+        cursor.close()
 
+def renew_lease(partner_order_id):
+    """
+    Продлевает аренду перед скачиванием. Возвращает False, если аренда уже истекла
+    или перешла другому экземпляру: тогда заказ качает он.
+    """
+    with get_connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute(
+            """
+            UPDATE pendingdocs
+            SET lease_expires_at = NOW() + INTERVAL %s SECOND
+            WHERE partner_order_id = %s AND lease_owner = %s AND lease_expires_at > NOW()
+            """,
+            (LEASE_SECONDS, partner_order_id, WORKER_ID)
+        )
+        renewed = cursor.rowcount > 0
+        cnx.commit()
+        cursor.close()
+    return renewed
+
+def download_all(rows):
+    """
+    Скачивает квитанции для строк pendingdocs в пуле потоков и ждёт завершения.
+
+    Возвращает число запущенных загрузок (строки, которые уже качаются, пропускаются).
+    """
+    futures = []
+    for row in rows:
+        with in_flight_lock:
+            if row['partner_order_id'] in in_flight:
+                continue
+            in_flight.add(row['partner_order_id'])
+            IN_FLIGHT.set(len(in_flight))
+        futures.append(download_executor.submit(
+            download_kvit,
+            transaction_id=row['transaction_id'],
+            partner_order_id=row['partner_order_id'],
+            customer_code=row['customer_code'],
+            document_url=row['document_url'],
+            attempts=row['attempts'],
+        ))
+    wait(futures)
+    return len(futures)
+
+def fetch_receipt(document_url, filepath):
+    """
+    Скачивает квитанцию по ссылке и кладёт её по пути filepath (или в BLOB_DIR).
+
+    Возвращает (путь для записи в БД, MD5). В БД ничего не пишет.
+    """
+    tmp_dir = BLOB_TMP_DIR if RECEIPT_STORAGE == "cas" else filepath.parent
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    started = time.perf_counter()
+    try:
+        with host_slot(document_url):
+            with http_session.get(document_url, timeout=DOWNLOAD_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                tmp_path, md5_hash = save_response(response, tmp_dir, filepath.name)
+    except Exception:
+        DOWNLOAD_SECONDS.observe(time.perf_counter() - started, result="error")
+        raise
+    DOWNLOAD_SECONDS.observe(time.perf_counter() - started, result="ok")
+    record_host_result(document_url, success=True)
+    DOWNLOADED_BYTES.inc(tmp_path.stat().st_size)
+
+    return place_receipt(tmp_path, md5_hash, filepath), md5_hash
+
+def download_kvit(transaction_id, partner_order_id, customer_code, document_url, attempts=0):
+    user_folder = BASE_DIR / f"{customer_code}_receipts"
     file_extension = get_file_extension(document_url)
     filename = f"{partner_order_id}_receipt{file_extension}"
     filepath = user_folder / filename
 
+    open_until = breaker_open_until(document_url)
+    if open_until:
+        try:
+            postpone(partner_order_id, open_until)
+        except mysql.connector.Error as err:
+            logger.error(f"Не удалось отложить загрузку для partner_order_id={partner_order_id}: {err}")
+        finally:
+            with in_flight_lock:
+                in_flight.discard(partner_order_id)
+                IN_FLIGHT.set(len(in_flight))
+        DOWNLOADS.inc(result="postponed")
+        return False
+
     try:
-        response = requests.get(document_url, timeout=30)
-        response.raise_for_status()
+        if not renew_lease(partner_order_id):
+            logger.warning(f"Аренда partner_order_id={partner_order_id} истекла до начала загрузки, заказ пропущен.")
+            DOWNLOADS.inc(result="postponed")
+            return False
 
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
+        receipt_path, md5_hash = fetch_receipt(document_url, filepath)
 
         added_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        local_link = f"{filepath.resolve()}"
-
-
-        md5_hash = calculate_md5(filepath)
-        if not md5_hash:
-            error_message = f"Не удалось вычислить MD5 хэш для {filename}"
-            logger.error(error_message)
-            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - {error_message}. Подробнее в логе.")
-            md5_hash = None
-
-        cursor_kv = cnx.cursor()
-        add_query = """
-        INSERT INTO orderdocstable (partner_order_id, transaction_id, customer_code, receipt_path, added_at, md5_hash)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        cursor_kv.execute(add_query, (partner_order_id, transaction_id, customer_code, local_link, added_at, md5_hash))
-        cnx.commit()
-        cursor_kv.close()
-
+        local_link = f"{receipt_path.resolve()}"
+
+        with get_connection() as cnx:
+            cursor_kv = cnx.cursor()
+            cursor_kv.execute(
+                "DELETE FROM pendingdocs WHERE partner_order_id = %s AND lease_owner = %s",
+                (partner_order_id, WORKER_ID)
+            )
+            if cursor_kv.rowcount == 0:
+                # Аренда истекла и заказ забрал другой экземпляр: запись в БД сделает он.
+                cnx.rollback()
+                cursor_kv.close()
+                logger.warning(f"Аренда partner_order_id={partner_order_id} перешла другому экземпляру, запись в БД пропущена.")
+                return True
+
+            add_query = """
+            INSERT INTO orderdocstable (partner_order_id, transaction_id, customer_code, receipt_path, added_at, md5_hash)
+            SELECT %s, %s, %s, %s, %s, %s
+            FROM DUAL
+            WHERE NOT EXISTS (SELECT 1 FROM orderdocstable WHERE partner_order_id = %s)
+            """
+            cursor_kv.execute(add_query, (partner_order_id, transaction_id, customer_code, local_link, added_at, md5_hash, partner_order_id))
+            cnx.commit()
+            cursor_kv.close()
+
+        DOWNLOADS.inc(result="ok")
         success_message = f"Квитанция {filename} успешно скачана, добавлен MD5 и добавлена в БД."
         print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - {success_message}")
 
-        with failed_downloads_lock:
-            if partner_order_id in failed_downloads:
-                failed_downloads.remove(partner_order_id)
-                logger.info(f"partner_order_id={partner_order_id} успешно загружен.  Удаляем из списка ошибок.")
+        if attempts:
+            logger.info(f"partner_order_id={partner_order_id} успешно загружен с попытки {attempts + 1}.")
 
         return True
 
     except (requests.RequestException, Exception) as e:
-        with failed_downloads_lock:
-            if partner_order_id not in failed_downloads:
-                error_message = f"Не удалось скачать квитанцию для partner_order_id={partner_order_id}: {e}"
-                logger.error(error_message)
-                print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - Ошибка скачивания квитанции для {partner_order_id}. Подробнее в логе.")
-                failed_downloads.add(partner_order_id)
-            else:
-                debug_message = f"Повторная ошибка скачивания квитанции для {partner_order_id}, не логируем повторно."
-                print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - {debug_message}")
-                logger.debug(debug_message) # Логируем повторные ошибки на уровне DEBUG
+        if is_host_failure(e):
+            record_host_result(document_url, success=False)
+
+        try:
+            dead = schedule_retry(partner_order_id, attempts, e)
+        except mysql.connector.Error as err:
+            logger.error(f"Не удалось запланировать повтор для partner_order_id={partner_order_id}: {err}")
+            dead = False
+
+        DOWNLOADS.inc(result="dead" if dead else "retry")
+        if dead:
+            error_message = f"Попытки скачать квитанцию для partner_order_id={partner_order_id} исчерпаны ({RETRY_MAX_ATTEMPTS}): {e}"
+            logger.error(error_message)
+            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - {error_message}")
+        elif attempts == 0:
+            error_message = f"Не удалось скачать квитанцию для partner_order_id={partner_order_id}: {e}"
+            logger.error(error_message)
+            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - Ошибка скачивания квитанции для {partner_order_id}. Подробнее в логе.")
+        else:
+            debug_message = f"Повторная ошибка скачивания квитанции для {partner_order_id}, не логируем повторно."
+            print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - {debug_message}")
+            logger.debug(debug_message) # Логируем повторные ошибки на уровне DEBUG
 
         return False
 
-def process_new_transactions():
-    try:
-        cnx = mysql.connector.connect(**DB_CONFIG)
-        cursor = cnx.cursor(dictionary=True)
+    finally:
+        with in_flight_lock:
+            in_flight.discard(partner_order_id)
+            IN_FLIGHT.set(len(in_flight))
+
+def claim_pending(retries, batch_size):
+    """
+    Забирает в аренду пачку заказов из pendingdocs, готовых к загрузке.
 
-        query = """
-        SELECT t.partner_order_id, t.transaction_id, t.customer_code, t.document_url
-        FROM orderstable t
-        LEFT JOIN orderdocstable k ON t.partner_order_id = k.partner_order_id
-        WHERE k.partner_order_id IS NULL
-        """
+    retries=False - новые заказы без попыток, retries=True - повторы, время которых
+    наступило. Строки, заблокированные другими экземплярами, пропускаются (SKIP LOCKED).
+    """
+    queue_name = "retry" if retries else "new"
+    with CLAIM_SECONDS.time(queue=queue_name), get_connection() as cnx:
+        cursor = cnx.cursor(dictionary=True)
+        cursor.execute(
+            """
+            SELECT partner_order_id
+            FROM pendingdocs
+            WHERE state = 'pending' AND attempts {} 0 AND next_attempt_at <= NOW()
+              AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+            ORDER BY next_attempt_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+            """.format(">" if retries else "="),
+            (batch_size,)
+        )
+        ids = [row['partner_order_id'] for row in cursor.fetchall()]
+
+        rows = []
+        if ids:
+            placeholders = ','.join(['%s'] * len(ids))
+            cursor.execute(
+                f"UPDATE pendingdocs SET lease_owner = %s, lease_expires_at = NOW() + INTERVAL %s SECOND WHERE partner_order_id IN ({placeholders})",
+                (WORKER_ID, LEASE_SECONDS, *ids)
+            )
+            cursor.execute(
+                f"""
+                SELECT p.partner_order_id, p.attempts, t.transaction_id, t.customer_code, t.document_url
+                FROM pendingdocs p
+                JOIN orderstable t ON t.partner_order_id = p.partner_order_id
+                WHERE p.partner_order_id IN ({placeholders})
+                """,
+                ids
+            )
+            rows = cursor.fetchall()
+        cnx.commit()
+        cursor.close()
+    CLAIMED_ROWS.inc(len(rows), queue=queue_name)
+    return rows
 
-        cursor.execute(query)
-        rows = cursor.fetchall()
+def process_new_transactions():
+    try:
         BASE_DIR.mkdir(exist_ok=True)
 
-        for row in rows:
-            download_kvit(row['partner_order_id'], row['transaction_id'], row['customer_code'], row['document_url'], cnx)
+        # Забранные в аренду строки не попадают в следующую пачку, поэтому
+        # стоимость проверки зависит от числа ожидающих квитанций, а не от размера orderstable.
+        while True:
+            rows = claim_pending(retries=False, batch_size=CLAIM_BATCH_SIZE)
+            if not rows:
+                break
+            poller.record(download_all(rows))
 
-        cursor.close()
-        cnx.close()
         print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - Проверка новых транзакций завершена.")
     except mysql.connector.Error as err:
         error_message = f"Ошибка работы с БД (новых транзакций): {err}"
@@ -162,27 +512,12 @@ def process_new_transactions():
 
 def process_failed_downloads():
     try:
-        cnx = mysql.connector.connect(**DB_CONFIG)
-        cursor = cnx.cursor(dictionary=True)
-
-        with failed_downloads_lock:
-            ids_to_retry = set(failed_downloads)
+        while True:
+            rows = claim_pending(retries=True, batch_size=CLAIM_BATCH_SIZE)
+            if not rows:
+                break
+            poller.record(download_all(rows))
 
-        query = """
-            SELECT t.partner_order_id, t.transaction_id, t.customer_code, t.document_url
-            FROM orderstable t
-            WHERE t.partner_order_id IN ({})
-            """.format(','.join(['%s'] * len(ids_to_retry))) if ids_to_retry else ""
-
-        if query:
-            cursor.execute(query, tuple(ids_to_retry))
-            rows = cursor.fetchall()
-
-            for row in rows:
-                download_kvit(row['partner_order_id'], row['transaction_id'], row['customer_code'], row['document_url'], cnx)
-
-        cursor.close()
-        cnx.close()
         print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {threading.current_thread().name} - Повторная проверка завершена.")
     except mysql.connector.Error as err:
         error_message = f"Ошибка работы с БД (повторные загрузки): {err}"
@@ -192,6 +527,8 @@ def process_failed_downloads():
 
 if __name__ == "__main__":
 
+    metrics.start(METRICS_PORT)
+
     while True:
 
         thread_new = threading.Thread(target=process_new_transactions, name="НовыеТранзакции")
@@ -204,4 +541,4 @@ if __name__ == "__main__":
         thread_failed.join()
 
         print(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - Главный поток - Ожидание перед следующей проверкой...")
-        time.sleep(20)
+        poller.wait()
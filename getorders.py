@@ -1,13 +1,32 @@
 import requests
+import requests.adapters
 import time
 import json
 import logging
 import threading
+import queue
 import mysql.connector
 import os
 import sys
+import hashlib
+import base64
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from decimal import Decimal
 from dotenv import load_dotenv
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import metrics
+from archive import ARCHIVE_DIR, ResponseArchive
+from polling import AdaptivePoller, THROTTLE_STATUSES, retry_after_seconds
+from db import DB_CONFIG, get_connection
+
 load_dotenv()
 
 LOG_FILE = os.getenv("LOG_FILE1")
@@ -24,6 +43,10 @@ logging.basicConfig(
 TOKEN_FILE = os.getenv("TOKEN_FILE")
 LOGIN_URL = os.getenv("LOGIN_URL")
 API_URL = os.getenv("API_URL")
+API_TIMEOUT = int(os.getenv("API_TIMEOUT", "60"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "4"))
+TOKEN_TTL = int(os.getenv("TOKEN_TTL", "3600"))
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "60"))
 
 LOGIN_DATA = {
     "user_login": os.getenv("USER_LOGIN"),
@@ -37,15 +60,61 @@ REQUEST_BODIES = [
     {"filter": {"payment_method_id": ""}, "sort": {"is_valid": True}, "limit": {"last_id": 0, "max_results": 512, "descending": True}}
 ]
 
-def save_token(token):
+# latest - только свежая страница каждого тела запроса;
+# incremental - только заказы новее сохранённой контрольной точки;
+# full - догрузка всей истории от новых к старым, затем incremental.
+SYNC_MODE = os.getenv("SYNC_MODE", "latest")
+CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE", "checkpoints.json")
+# Страницы, которые не удалось записать из-за неустранимой ошибки (JSONL, по строке на страницу).
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", "dead_letter_pages.jsonl")
+
+# Ошибки соединения с БД, после которых запись страницы повторяется; остальные ошибки
+# (DataError, ошибки разбора) повторились бы бесконечно и остановили запись.
+TRANSIENT_DB_ERRORS = (
+    mysql.connector.errors.OperationalError,
+    mysql.connector.errors.InterfaceError,
+    mysql.connector.errors.PoolError,
+)
+
+UPSERT_CHUNK_SIZE = int(os.getenv("UPSERT_CHUNK_SIZE", "256"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+FINGERPRINT_CACHE_SIZE = int(os.getenv("FINGERPRINT_CACHE_SIZE", "200000"))
+# trigger - customers пересчитывают триггеры на каждую строку;
+# batch - триггеры отключаются на время записи страницы, клиенты пересчитываются один раз.
+CUSTOMERS_REFRESH = os.getenv("CUSTOMERS_REFRESH", "trigger")
+
+# guarded=True - повторная запись (archive.py replay): версия старше строки в БД её не заменяет.
+Page = namedtuple("Page", ["rows", "checkpoints", "guarded"], defaults=(False,))
+
+# Порт HTTP-сервера метрик (0 - не запускать).
+METRICS_PORT = int(os.getenv("METRICS_PORT1", "0"))
+# Корзины задержки актуальности, в секундах: от секунд до суток.
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400)
+
+API_REQUEST_SECONDS = metrics.histogram("orders_api_request_seconds", "Время запроса страницы к API, включая чтение ответа.", ["status"])
+TOKEN_REFRESH_SECONDS = metrics.histogram("orders_token_refresh_seconds", "Время получения нового токена.")
+TOKEN_REFRESHES = metrics.counter("orders_token_refreshes_total", "Запросы нового токена по результату.", ["result"])
+DB_WRITE_SECONDS = metrics.histogram("orders_db_write_seconds", "Время записи страницы в orderstable, включая commit.", ["mode"])
+DB_RETRIES = metrics.counter("orders_db_retries_total", "Повторы записи страницы после ошибки БД.")
+ORDER_ROWS = metrics.counter("orders_rows_total", "Строки страниц по результату записи.", ["result"])
+QUEUE_DEPTH = metrics.gauge("orders_pipeline_queue_depth", "Страниц в очереди между загрузкой и записью.")
+FRESHNESS_LAG_SECONDS = metrics.histogram(
+    "orders_freshness_lag_seconds", "Задержка между updated_at заказа и его записью в БД.", buckets=LAG_BUCKETS
+)
+
+# Ошибки разбора ответа API: при установленном ijson ответ разбирается потоково.
+JSON_ERRORS = (json.JSONDecodeError, ijson.JSONError) if ijson else (json.JSONDecodeError,)
+
+def save_token(token, expires_at=None):
     try:
         with open(TOKEN_FILE, "w") as f:
-            json.dump({"token": token}, f)
+            json.dump({"token": token, "expires_at": expires_at}, f)
         logging.info("Токен сохранен в файл.")
     except Exception as e:
         logging.error(f"Ошибка сохранения токена: {e}")
 
 def load_token():
+    """Возвращает (токен, время истечения) из TOKEN_FILE или (None, None)."""
     if os.path.exists(TOKEN_FILE):
         try:
             with open(TOKEN_FILE, "r") as f:
@@ -53,292 +122,747 @@ def load_token():
                 token = data.get("token")
                 if token:
                     logging.info("Токен загружен из файла.")
-                    return token
+                    return token, data.get("expires_at") or token_expiry(token)
         except Exception as e:
             logging.error(f"Ошибка загрузки токена из файла: {e}")
-    return None
+    return None, None
 
-def get_new_token():
+def token_expiry(token, expires_in=None):
+    """Время истечения токена: из expires_in, из поля exp JWT или через TOKEN_TTL."""
+    if expires_in:
+        return time.time() + float(expires_in)
+    try:
+        claims = token.split(".")[1]
+        claims += "=" * (-len(claims) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(claims)).get("exp")
+        if exp:
+            return float(exp)
+    except (IndexError, ValueError, AttributeError):
+        pass
+    return time.time() + TOKEN_TTL
+
+def get_new_token(session):
+    """Возвращает (токен, время истечения) или (None, None)."""
     logging.info("Запрос нового токена...")
     try:
-        response = requests.post(LOGIN_URL, json=LOGIN_DATA)
+        with TOKEN_REFRESH_SECONDS.time():
+            response = session.post(LOGIN_URL, json=LOGIN_DATA, timeout=API_TIMEOUT)
         response.raise_for_status()
         resp_json = response.json()
         token = resp_json.get("access_token")
         if token:
-            save_token(token)
-            return token
+            expires_at = token_expiry(token, resp_json.get("expires_in"))
+            save_token(token, expires_at)
+            TOKEN_REFRESHES.inc(result="ok")
+            return token, expires_at
         else:
             logging.error("Токен не найден в ответе сервера.")
     except requests.RequestException as e:
         logging.error(f"Ошибка при получении токена: {e}")
     except Exception as e:
         logging.error(f"Неожиданная ошибка при получении токена: {e}")
-    return None
-
-def get_data(output_file="data.json"):
-    headers = {
+    TOKEN_REFRESHES.inc(result="error")
+    return None, None
+
+def create_session():
+    """HTTP-сессия с пулом keep-alive соединений для LOGIN_URL и API_URL."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
         "Content-Type": "application/json;charset=UTF-8",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36"
+    })
+    return session
+
+class TokenManager:
+    """
+    Хранит токен в памяти и обновляет его до истечения.
+
+    Одновременные запросы на обновление выполняются одним обращением к LOGIN_URL,
+    остальные потоки получают уже обновлённый токен.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self._token, self._expires_at = load_token()
+
+    def _is_fresh(self):
+        return self._token is not None and time.time() < self._expires_at - TOKEN_REFRESH_MARGIN
+
+    def get(self):
+        if self._is_fresh():
+            return self._token
+        return self.refresh()
+
+    def refresh(self, stale=None):
+        """Обновляет токен; stale - токен, который отверг сервер."""
+        with self._lock:
+            # Пока мы ждали блокировку, токен мог обновить другой поток.
+            if self._is_fresh() and self._token != stale:
+                return self._token
+            token, expires_at = get_new_token(self.session)
+            if token:
+                self._token, self._expires_at = token, expires_at
+            return token
+
+def load_checkpoints():
+    if os.path.exists(CHECKPOINT_FILE):
+        try:
+            with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"Ошибка загрузки контрольных точек из файла: {e}")
+    return {}
+
+def save_checkpoints(checkpoints):
+    tmp_file = f"{CHECKPOINT_FILE}.tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(checkpoints, f, ensure_ascii=False)
+        os.replace(tmp_file, CHECKPOINT_FILE)
+    except Exception as e:
+        logging.error(f"Ошибка сохранения контрольных точек: {e}")
+
+def dead_letter_page(page, error):
+    """Дописывает строки незаписанной страницы в DEAD_LETTER_FILE для разбора вручную."""
+    entry = {
+        "failed_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "error": str(error),
+        "checkpoints": page.checkpoints,
+        "rows": [row._asdict() for row in page.rows],
     }
+    try:
+        with open(DEAD_LETTER_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+    except Exception as e:
+        logging.error(f"Ошибка записи страницы в {DEAD_LETTER_FILE}: {e}")
+
+def body_key(body):
+    """Ключ контрольной точки тела запроса: фильтр и сортировка без курсора."""
+    return json.dumps({"filter": body.get("filter"), "sort": body.get("sort")}, sort_keys=True, ensure_ascii=False)
+
+def build_payload(body, checkpoint):
+    """
+    Подставляет курсор last_id из контрольной точки в тело запроса.
+
+    API отдаёт заказы после last_id в порядке сортировки: при descending=True
+    это заказы старше курсора, при descending=False - новее.
+    """
+    limit = dict(body["limit"])
+    if SYNC_MODE == "full" and not checkpoint.get("backfill_done"):
+        limit["last_id"] = checkpoint.get("backfill_id") or 0
+        limit["descending"] = True
+    elif SYNC_MODE in ("incremental", "full"):
+        limit["last_id"] = checkpoint.get("last_id", 0)
+        limit["descending"] = False
+    return {**body, "limit": limit}
+
+def advance_checkpoint(body, checkpoint, rows, received):
+    """
+    Возвращает (новая контрольная точка, есть ли ещё страницы).
+
+    received - число записей в ответе, включая записи без order_id.
+    """
+    ids = []
+    for row in rows:
+        try:
+            ids.append(int(row.partner_order_id))
+        except (TypeError, ValueError):
+            continue
 
-    body_index = 0
+    has_more = received >= body["limit"]["max_results"]
+    checkpoint = dict(checkpoint)
+    if ids:
+        checkpoint["last_id"] = max(checkpoint.get("last_id", 0), max(ids))
+
+    if SYNC_MODE == "full" and not checkpoint.get("backfill_done"):
+        if ids:
+            checkpoint["backfill_id"] = min(ids)
+        if not has_more:
+            checkpoint["backfill_done"] = True
+            # После догрузки истории переходим к заказам новее last_id.
+            has_more = True
+
+    return checkpoint, has_more and bool(ids)
+
+def post_api(session, tokens, payload):
+    """
+    Отправляет запрос к API_URL с потоковым чтением ответа.
+
+    При 401 токен обновляется и запрос повторяется один раз.
+    Возвращает ответ или None, если получить токен не удалось.
+    """
+    token = tokens.get()
+    if not token:
+        return None
+
+    response = session.post(API_URL, headers={"Authorization": f"Bearer {token}"}, json=payload, timeout=API_TIMEOUT, stream=True)
+
+    if response.status_code == 401:
+        response.close()
+        logging.warning("Токен недействителен, получаем новый...")
+        token = tokens.refresh(stale=token)
+        if not token:
+            return None
+        response = session.post(API_URL, headers={"Authorization": f"Bearer {token}"}, json=payload, timeout=API_TIMEOUT, stream=True)
 
-    while True:
+    return response
+
+def iter_records(response):
+    """Разбирает JSON-массив ответа по одной записи, не загружая тело целиком."""
+    if ijson is None:
+        yield from response.json()
+        return
+    response.raw.decode_content = True
+    yield from ijson.items(response.raw, "item", use_float=True)
+
+def read_rows(response, archive=None, key=None):
+    """
+    Возвращает (строки OrderRow, число записей в ответе).
+
+    Если передан архив, сырые записи страницы сжимаются по мере разбора
+    и дописываются в него под ключом key.
+    """
+    writer = archive.page(key) if archive is not None else None
+
+    rows = []
+    received = 0
+    for record in iter_records(response):
+        received += 1
+        if writer is not None:
+            writer.add(record)
+        row = record_to_row(record)
+        if row is not None:
+            rows.append(row)
+
+    if writer is not None:
         try:
-            token = load_token()
-            if not token:
-                token = get_new_token()
-                if not token:
-                    logging.error("Не удалось получить токен, пропускаем итерацию.")
-                    time.sleep(60)
-                    continue
-
-            headers["Authorization"] = f"Bearer {token}"
-            payload = REQUEST_BODIES[body_index]
-
-            response = requests.post(API_URL, headers=headers, json=payload)
-
-            if response.status_code == 401:
-                logging.warning("Токен недействителен, получаем новый...")
-                token = get_new_token()
-                if not token:
-                    logging.error("Не удалось обновить токен, пропускаем итерацию.")
-                    time.sleep(60)
-                    continue
-                headers["Authorization"] = f"Bearer {token}"
-                response = requests.post(API_URL, headers=headers, json=payload)
+            writer.close()
+        except OSError as e:
+            logging.error(f"Ошибка записи страницы в архив ответов: {e}")
+    return rows, received
+
+def fetch_body(session, tokens, body, checkpoint, archive=None, latest=False):
+    """
+    Загружает одну страницу по телу запроса.
+
+    latest=True - свежая страница без курсора, контрольная точка не меняется.
+    Возвращает (строки, число записей в ответе, новая контрольная точка, есть ли ещё страницы)
+    или None, если получить токен не удалось.
+    """
+    latest = latest or SYNC_MODE == "latest"
+    payload = body if latest else build_payload(body, checkpoint)
+
+    started = time.perf_counter()
+    response = post_api(session, tokens, payload)
+    if response is None:
+        return None
 
+    try:
+        with response:
             response.raise_for_status()
+            rows, received = read_rows(response, archive, body_key(body))
+    finally:
+        API_REQUEST_SECONDS.observe(time.perf_counter() - started, status=response.status_code)
+
+    has_more = False
+    if not latest:
+        checkpoint, has_more = advance_checkpoint(body, checkpoint, rows, received)
+    return rows, received, checkpoint, has_more
+
+def merge_rows(row_lists):
+    """Объединяет строки нескольких ответов: по каждому заказу остаётся версия с наибольшим updated_at."""
+    merged = {}
+    for rows in row_lists:
+        for row in rows:
+            current = merged.get(row.partner_order_id)
+            if current is None or (row.updated_at or "") >= (current.updated_at or ""):
+                merged[row.partner_order_id] = row
+    return list(merged.values())
+
+def get_data(pages, session, tokens, poller, archive=None):
+    checkpoints = load_checkpoints()
+
+    # Одинаковые тела запроса дают одинаковые ответы и делят контрольную точку.
+    bodies = {}
+    for body in REQUEST_BODIES:
+        bodies.setdefault(body_key(body), body)
+
+    executor = ThreadPoolExecutor(max_workers=min(2 * len(bodies), HTTP_POOL_SIZE), thread_name_prefix="api")
+    active = list(bodies)
+    full_cycle = True
 
-            data = response.json()
+    while True:
+        poller.hold()
+        futures = {
+            (key, False): executor.submit(fetch_body, session, tokens, bodies[key], checkpoints.get(key, {}), archive)
+            for key in active
+        }
+        # Курсор incremental/full видит только заказы новее last_id, поэтому в каждом цикле
+        # дополнительно запрашивается свежая страница: так доходят изменения статуса недавних заказов.
+        if full_cycle and SYNC_MODE != "latest":
+            for key in active:
+                futures[(key, True)] = executor.submit(fetch_body, session, tokens, bodies[key], {}, archive, True)
+
+        row_lists = []
+        page_checkpoints = {}
+        next_active = []
+        token_failed = False
+        for (key, latest), future in futures.items():
+            try:
+                result = future.result()
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code in THROTTLE_STATUSES:
+                    retry_after = retry_after_seconds(e.response)
+                    poller.throttle(retry_after)
+                    logging.warning(f"API ограничивает частоту запросов ({e.response.status_code}), пауза: {retry_after or poller.interval} сек.")
+                else:
+                    logging.error(f"Ошибка запроса: {e}")
+                continue
+            except requests.RequestException as e:
+                logging.error(f"Ошибка запроса: {e}")
+                continue
+            except JSON_ERRORS as e:
+                logging.error(f"Ошибка декодирования JSON, тело запроса пропускается до следующего цикла.")
+                continue
+            except Exception as e:
+                logging.error(f"Неожиданная ошибка: {e}")
+                continue
+
+            if result is None:
+                token_failed = True
+                continue
+
+            rows, received, checkpoint, has_more = result
+            row_lists.append(rows)
+            logging.info(f"Данные успешно обновлены. Получено объектов: {received}")
+            if latest:
+                continue
+            if SYNC_MODE != "latest":
+                checkpoints[key] = page_checkpoints[key] = checkpoint
+            if has_more:
+                next_active.append(key)
+
+        if row_lists:
+            rows = merge_rows(row_lists)
+            # Если обработчик не успевает, put блокирует загрузку до освобождения места.
+            pages.put(Page(rows, page_checkpoints))
+            QUEUE_DEPTH.set(pages.qsize())
+            logging.info(f"На запись передано заказов: {len(rows)} (ответов объединено: {len(row_lists)}).")
+        elif token_failed:
+            logging.error("Не удалось получить токен, пропускаем итерацию.")
+            time.sleep(60)
+            active = list(bodies)
+            full_cycle = True
+            continue
 
-            with open(output_file, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+        # Пока курсор тела не дошёл до конца выборки, его следующую страницу берём сразу.
+        active = next_active
+        full_cycle = False
+        if not active:
+            poller.wait()
+            active = list(bodies)
+            full_cycle = True
+
+def parse_datetime(dt_str):
+    if not dt_str:
+        return None
+    return dt_str[:19].replace("T", " ")
+
+def parse_amount(amount_str):
+    return float(amount_str) if amount_str else None
+
+# Единое описание соответствия полей: (столбец orderstable, путь в записи API, преобразование).
+# Из него строятся список столбцов для INSERT/UPDATE, тип строки и функции извлечения.
+ORDER_FIELDS = (
+    ("partner_order_id", ("order_id",), None),
+    ("transaction_id", ("internal_id",), None),
+    ("status", ("order_status",), None),
+    ("customer_code", ("customer_code",), None),
+    ("aboutorder_info1", ("aboutorder_info1",), None),
+    ("aboutorder_info2", ("aboutorder_info2",), None),
+    ("aboutorder_info3", ("aboutorder_info3",), None),
+    ("aboutorder_info4", ("aboutorder_info4",), None),
+    ("aboutorder_info5", ("aboutorder_info5",), None),
+    ("document_url", ("additional_info", "document_url"), None),
+    ("aboutorder_info6", ("additional_info", "aboutorder_info6"), None),
+    ("aboutorder_info7", ("additional_info", "aboutorder_info7"), None),
+    ("partner_id", ("partner", "internal_id"), None),
+    ("aboutpartner_info1", ("partner", "aboutpartner_info1"), None),
+    ("aboutpartner_info2", ("partner", "aboutpartner_info2"), None),
+    ("aboutpartner_info3", ("partner", "aboutpartner_info3"), None),
+    ("payment_method_id", ("payment_details", "internal_id"), None),
+    ("aboutpayment_info1", ("payment_details", "aboutpayment_info1"), None),
+    ("aboutpayment_info2", ("payment_details", "aboutpayment_info2"), None),
+    ("created_at", ("created_at",), parse_datetime),
+    ("updated_at", ("updated_at",), parse_datetime),
+    ("payment_amount", ("payment_amount",), parse_amount),
+    ("responsible_user_username", ("responsible_user", "username"), None),
+)
 
-            logging.info(f"Данные успешно обновлены. Получено объектов: {len(data)}")
-            body_index = (body_index + 1) % len(REQUEST_BODIES)
+ORDER_COLUMNS = tuple(column for column, _, _ in ORDER_FIELDS)
 
-        except requests.RequestException as e:
-            logging.error(f"Ошибка запроса: {e}")
-        except json.JSONDecodeError as e:
-            logging.error(f"Ошибка декодирования JSON, пробуем следующее тело запроса.")
-            body_index = (body_index + 1) % len(REQUEST_BODIES)
-        except Exception as e:
-            logging.error(f"Неожиданная ошибка: {e}")
+# Строка orderstable: кортеж без словаря атрибутов, заметно компактнее исходной записи API.
+OrderRow = namedtuple("OrderRow", ORDER_COLUMNS)
 
-        time.sleep(20)
+def compile_field(path, convert):
+    """Строит функцию извлечения одного поля из записи API."""
+    if len(path) == 1:
+        key = path[0]
 
-def parse_and_insert(output_file="data.json", interval=20):
-    db_config = {
-        "host": os.getenv("DB_HOST"),
-        "user": os.getenv("DB_USER"),
-        "password": os.getenv("DB_PASSWORD"),
-        "database": os.getenv("DB_DATABASE"),
-        "port": int(os.getenv("DB_PORT")),
-    }
+        def extract(record):
+            return record.get(key)
+    else:
+        outer, inner = path
 
-    if not all(db_config.values()):
-        logging.error("Не все параметры базы данных заданы в переменных окружения.")
-        return
+        def extract(record):
+            nested = record.get(outer)
+            return nested.get(inner) if isinstance(nested, dict) else None
 
-    def parse_datetime(dt_str):
-        if not dt_str:
-            return None
-        return dt_str[:19].replace("T", " ")
+    if convert is None:
+        return extract
+    return lambda record: convert(extract(record))
 
-    while True:
-        try:
-            with open(output_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except FileNotFoundError:
-            logging.warning(f"Файл {output_file} не найден. Ожидаю его появления...")
-            time.sleep(interval)
-            continue
-        except json.JSONDecodeError:
-            logging.warning(f"Файл {output_file} содержит некорректный JSON. Жду следующего обновления...")
-            time.sleep(interval)
+ORDER_EXTRACTORS = tuple(compile_field(path, convert) for _, path, convert in ORDER_FIELDS)
+
+UPSERT_QUERY_HEAD = "INSERT INTO orderstable ({}) VALUES ".format(", ".join(ORDER_COLUMNS))
+UPSERT_ROW_PLACEHOLDER = "({})".format(", ".join(["%s"] * len(ORDER_COLUMNS)))
+UPSERT_QUERY_TAIL = " ON DUPLICATE KEY UPDATE " + ", ".join(
+    f"{column} = VALUES({column})" for column in ORDER_COLUMNS[1:]
+)
+
+def guarded_upsert_tail(table):
+    """
+    ON DUPLICATE KEY UPDATE, который не заменяет строку table версией с меньшим updated_at.
+
+    MySQL выполняет присваивания слева направо, поэтому updated_at обновляется последним:
+    иначе условие для остальных столбцов сравнивало бы уже новое значение.
+    """
+    columns = [column for column in ORDER_COLUMNS[1:] if column != "updated_at"] + ["updated_at"]
+    newer = f"({table}.updated_at IS NULL OR VALUES(updated_at) >= {table}.updated_at)"
+    return " ON DUPLICATE KEY UPDATE " + ", ".join(
+        f"{column} = IF({newer}, VALUES({column}), {table}.{column})" for column in columns
+    )
+
+CUSTOMERS_REFRESH_QUERY = """
+INSERT INTO customers (customer_code, completed_orders, total_orders, lastcompleted_order, last_order, minamount, maxamount, avgamount, amount_count, amount_sum)
+SELECT
+    customer_code,
+    SUM(CASE WHEN status = 1 THEN 1 ELSE 0 END),
+    COUNT(*),
+    MAX(CASE WHEN status = 1 THEN updated_at ELSE NULL END),
+    MAX(created_at),
+    MIN(CASE WHEN status = 1 THEN payment_amount ELSE NULL END),
+    MAX(CASE WHEN status = 1 THEN payment_amount ELSE NULL END),
+    AVG(CASE WHEN status = 1 THEN payment_amount ELSE NULL END),
+    COUNT(CASE WHEN status = 1 THEN payment_amount ELSE NULL END),
+    COALESCE(SUM(CASE WHEN status = 1 THEN payment_amount ELSE NULL END), 0)
+FROM orderstable
+WHERE customer_code IN ({})
+GROUP BY customer_code
+ON DUPLICATE KEY UPDATE
+    completed_orders = VALUES(completed_orders),
+    total_orders = VALUES(total_orders),
+    lastcompleted_order = VALUES(lastcompleted_order),
+    last_order = VALUES(last_order),
+    minamount = VALUES(minamount),
+    maxamount = VALUES(maxamount),
+    avgamount = VALUES(avgamount),
+    amount_count = VALUES(amount_count),
+    amount_sum = VALUES(amount_sum)
+"""
+
+CUSTOMERS_RESET_QUERY = """
+UPDATE customers
+SET completed_orders = 0, total_orders = 0, lastcompleted_order = NULL, last_order = NULL,
+    minamount = NULL, maxamount = NULL, avgamount = NULL, amount_count = 0, amount_sum = 0
+WHERE customer_code IN ({})
+  AND NOT EXISTS (SELECT 1 FROM orderstable o WHERE o.customer_code = customers.customer_code)
+"""
+
+def record_to_row(record):
+    """Преобразует запись API в OrderRow или возвращает None для записи без order_id."""
+    if record.get("order_id") is None:
+        return None
+    return OrderRow._make([extract(record) for extract in ORDER_EXTRACTORS])
+
+def has_unique_order_key(cursor):
+    """Есть ли в orderstable уникальный индекс ровно по partner_order_id (см. orderstable_unique.sql)."""
+    cursor.execute("SHOW INDEX FROM orderstable")
+    columns = [column[0] for column in cursor.description]
+    indexes = {}
+    for values in cursor.fetchall():
+        index = dict(zip(columns, values))
+        if int(index["Non_unique"]) == 0:
+            indexes.setdefault(index["Key_name"], []).append((index["Seq_in_index"], index["Column_name"]))
+    return any([name for _, name in sorted(parts)] == ["partner_order_id"] for parts in indexes.values())
+
+def chunked(items, size):
+    """Разбивает последовательность на части не длиннее size."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def upsert_orders(cursor, rows, chunk_size=UPSERT_CHUNK_SIZE, touched_customers=None, guarded=False):
+    """
+    Записывает строки в orderstable пачками через INSERT ... ON DUPLICATE KEY UPDATE.
+
+    Требует уникального индекса по orderstable.partner_order_id.
+    Если передано множество touched_customers, в него добавляются прежние
+    и новые customer_code затронутых заказов.
+    guarded=True - строка в БД с большим updated_at не заменяется (такие строки
+    всё равно считаются обновлёнными).
+    Возвращает кортеж (добавлено, обновлено).
+    """
+    if guarded:
+        rows = merge_rows([rows])
+        tail = guarded_upsert_tail("orderstable")
+    else:
+        # Повторы одного заказа на странице схлопываем, побеждает последняя версия.
+        rows = list({row[0]: row for row in rows}.values())
+        tail = UPSERT_QUERY_TAIL
+    customer_index = ORDER_COLUMNS.index("customer_code")
+
+    added = 0
+    updated = 0
+    for chunk in chunked(rows, chunk_size):
+        ids = [row[0] for row in chunk]
+        cursor.execute(
+            "SELECT partner_order_id, customer_code FROM orderstable WHERE partner_order_id IN ({})".format(", ".join(["%s"] * len(ids))),
+            ids
+        )
+        existing = {}
+        for found_id, found_customer in cursor.fetchall():
+            existing[str(found_id)] = found_customer
+
+        query = UPSERT_QUERY_HEAD + ", ".join([UPSERT_ROW_PLACEHOLDER] * len(chunk)) + tail
+        cursor.execute(query, [value for row in chunk for value in row])
+
+        chunk_updated = sum(1 for partner_order_id in ids if str(partner_order_id) in existing)
+        updated += chunk_updated
+        added += len(chunk) - chunk_updated
+
+        if touched_customers is not None:
+            touched_customers.update(existing.values())
+            touched_customers.update(row[customer_index] for row in chunk)
+
+    return added, updated
+
+@contextmanager
+def bulk_ingest(cursor):
+    """
+    Отключает пересчёт customers в триггерах orderstable на время блока.
+
+    Триггеры проверяют сессионную переменную @orders_bulk_ingest, поэтому
+    агрегаты затронутых клиентов нужно обновить refresh_customers в той же транзакции.
+    """
+    cursor.execute("SET @orders_bulk_ingest = 1")
+    try:
+        yield
+    finally:
+        cursor.execute("SET @orders_bulk_ingest = 0")
+
+def refresh_customers(cursor, customer_codes, chunk_size=UPSERT_CHUNK_SIZE):
+    """Пересчитывает строки customers для переданных клиентов одним запросом на пачку."""
+    customer_codes = [code for code in customer_codes if code is not None]
+    for chunk in chunked(customer_codes, chunk_size):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(CUSTOMERS_REFRESH_QUERY.format(placeholders), chunk)
+        # Клиенты, у которых не осталось заказов (например, после смены customer_code).
+        cursor.execute(CUSTOMERS_RESET_QUERY.format(placeholders), chunk)
+
+def normalize_value(value):
+    """Приводит значение из API или из БД к общему виду для сравнения."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, (float, Decimal)):
+        return repr(float(value))
+    return str(value)
+
+def row_fingerprint(row):
+    """Отпечаток нормализованной строки orderstable."""
+    normalized = tuple(normalize_value(value) for value in row)
+    return hashlib.blake2b(repr(normalized).encode("utf-8"), digest_size=16).digest()
+
+def observe_freshness(rows):
+    """
+    Отмечает в метриках, насколько запись в БД отстала от updated_at заказов.
+
+    parse_datetime отбрасывает смещение часового пояса, поэтому updated_at считается
+    временем UTC (API отдаёт его с суффиксом Z) и сравнивается с текущим временем UTC,
+    а не с местным временем сервера.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    for row in rows:
+        if not row.updated_at:
             continue
-        except Exception as e:
-            logging.error(f"Ошибка при чтении {output_file}: {e}")
-            time.sleep(interval)
+        try:
+            lag = (now - datetime.strptime(row.updated_at, '%Y-%m-%d %H:%M:%S')).total_seconds()
+        except (TypeError, ValueError):
             continue
+        FRESHNESS_LAG_SECONDS.observe(max(lag, 0))
+
+class FingerprintCache:
+    """Ограниченный LRU-кэш отпечатков строк orderstable по partner_order_id."""
+
+    def __init__(self, max_size=FINGERPRINT_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def warm(self, cursor):
+        """Заполняет кэш последними изменёнными заказами из orderstable."""
+        cursor.execute(
+            "SELECT {} FROM orderstable ORDER BY updated_at DESC LIMIT %s".format(", ".join(ORDER_COLUMNS)),
+            (self.max_size,)
+        )
+        # Строки идут от свежих к старым, поэтому каждую ставим в начало очереди
+        # вытеснения: самые свежие заказы в итоге окажутся в её конце.
+        with self._lock:
+            for row in cursor:
+                key = str(row[0])
+                self._items[key] = row_fingerprint(row)
+                self._items.move_to_end(key, last=False)
+
+    def split_changed(self, rows):
+        """Возвращает (новые или изменённые строки, количество неизменных)."""
+        changed = []
+        unchanged = 0
+        with self._lock:
+            for row in rows:
+                key = str(row[0])
+                cached = self._items.get(key)
+                if cached is not None and cached == row_fingerprint(row):
+                    self._items.move_to_end(key)
+                    unchanged += 1
+                else:
+                    changed.append(row)
+        return changed, unchanged
+
+    def remember(self, rows):
+        """Запоминает отпечатки строк, записанных в БД."""
+        with self._lock:
+            for row in rows:
+                key = str(row[0])
+                self._items[key] = row_fingerprint(row)
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+def parse_and_insert(pages, poller=None):
+    if not all(DB_CONFIG.values()):
+        logging.error("Не все параметры базы данных заданы в переменных окружения.")
+        return
 
+    while True:
         try:
-            with mysql.connector.connect(**db_config) as conn:
+            with get_connection() as conn:
                 with conn.cursor() as cursor:
-                    added = 0
-                    updated = 0
-
-                    for record in data:
-                        partner_order_id = record.get("order_id")
-                        if partner_order_id is None:
-                            continue
-
-                        transaction_id = record.get("internal_id")
-                        status = record.get("order_status")
-
-                        partner = record.get("partner", {})
-                        partner_id = partner.get("internal_id")
-                        aboutpartner_info1 = partner.get("aboutpartner_info1")
-                        aboutpartner_info2 = partner.get("aboutpartner_info2")
-                        aboutpartner_info3 = partner.get("aboutpartner_info3")
-
-                        payment_details = record.get("payment_details", {})
-                        payment_method_id = payment_details.get("internal_id")
-                        aboutpayment_info1 = payment_details.get("aboutpayment_info1")
-                        aboutpayment_info2 = payment_details.get("aboutpayment_info2")
-
-                        customer_code = record.get("customer_code")
-                        aboutorder_info1 = record.get("aboutorder_info1")
-                        aboutorder_info2 = record.get("aboutorder_info2")
-                        aboutorder_info3 = record.get("aboutorder_info3")
-                        aboutorder_info4 = record.get("aboutorder_info4")
-                        aboutorder_info5 = record.get("aboutorder_info5")
-                        document_url = record.get("additional_info", {}).get("document_url")
-                        aboutorder_info6 = record.get("additional_info", {}).get("aboutorder_info6")
-                        aboutorder_info7 = record.get("additional_info", {}).get("aboutorder_info7")
-
-                        created_at = parse_datetime(record.get("created_at"))
-                        updated_at = parse_datetime(record.get("updated_at"))
-                        payment_amount_str = record.get("payment_amount")
-                        payment_amount = float(payment_amount_str) if payment_amount_str else None
-
-                        responsible_user_username = None
-                        if "responsible_user" in record and isinstance(record["responsible_user"], dict) and "username" in record["responsible_user"]:
-                            responsible_user_username = record["responsible_user"]["username"]
-
-                        cursor.execute("SELECT COUNT(*) FROM orderstable WHERE partner_order_id = %s", (partner_order_id,))
-                        exists = cursor.fetchone()[0] > 0
-
-                        if exists:
-                            update_query = """
-                            UPDATE orderstable SET
-                                transaction_id = %s,
-                                status = %s,
-                                customer_code = %s,
-                                aboutorder_info1 = %s,  
-                                aboutorder_info2 = %s,
-                                aboutorder_info3 = %s,
-                                aboutorder_info4 = %s,
-                                aboutorder_info5 = %s,
-                                document_url = %s,
-                                aboutorder_info6 = %s,
-                                aboutorder_info7 = %s,
-                                partner_id = %s,
-                                aboutpartner_info1 = %s,
-                                aboutpartner_info2 = %s,
-                                aboutpartner_info3 = %s,
-                                payment_method_id = %s,
-                                aboutpayment_info1 = %s,
-                                aboutpayment_info2 = %s,
-                                created_at = %s,
-                                updated_at = %s,
-                                payment_amount = %s,
-                                responsible_user_username = %s
-                            WHERE partner_order_id = %s
-                            """
-                            params = (
-                                transaction_id,
-                                status,
-                                customer_code,
-                                aboutorder_info1,
-                                aboutorder_info2,
-                                aboutorder_info3,
-                                aboutorder_info4,
-                                aboutorder_info5,
-                                document_url,
-                                aboutorder_info6,
-                                aboutorder_info7,
-                                partner_id,
-                                aboutpartner_info1,
-                                aboutpartner_info2,
-                                aboutpartner_info3,
-                                payment_method_id,
-                                aboutpayment_info1,
-                                aboutpayment_info2,
-                                created_at,
-                                updated_at,
-                                payment_amount,
-                                responsible_user_username,
-                                partner_order_id
-                            )
-                            cursor.execute(update_query, params)
-                            updated += 1
-                        else:
-                            insert_query = """
-                            INSERT INTO orderstable (
-                                partner_order_id,
-                                transaction_id,
-                                status,
-                                customer_code,
-                                aboutorder_info1,
-                                aboutorder_info2,
-                                aboutorder_info3,
-                                aboutorder_info4,
-                                aboutorder_info5,
-                                document_url,
-                                aboutorder_info6,
-                                aboutorder_info7,
-                                partner_id,
-                                aboutpartner_info1,
-                                aboutpartner_info2,
-                                aboutpartner_info3,
-                                payment_method_id,
-                                aboutpayment_info1,
-                                aboutpayment_info2,
-                                created_at,
-                                updated_at,
-                                payment_amount,
-                                responsible_user_username
-                            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            """
-
-                            params = (
-                                partner_order_id,
-                                transaction_id,
-                                status,
-                                customer_code,
-                                aboutorder_info1,
-                                aboutorder_info2,
-                                aboutorder_info3,
-                                aboutorder_info4,
-                                aboutorder_info5,
-                                document_url,
-                                aboutorder_info6,
-                                aboutorder_info7,
-                                partner_id,
-                                aboutpartner_info1,
-                                aboutpartner_info2,
-                                aboutpartner_info3,
-                                payment_method_id,
-                                aboutpayment_info1,
-                                aboutpayment_info2,
-                                created_at,
-                                updated_at,
-                                payment_amount,
-                                responsible_user_username
-                            )
-
-                            cursor.execute(insert_query, params)
-                            added += 1
-
-                    conn.commit()
-                    logging.info(f"Добавлено записей: {added}, Обновлено записей: {updated}")
-
+                    unique_key = has_unique_order_key(cursor)
+            break
         except mysql.connector.Error as err:
-            logging.error(f"Ошибка при работе с базой данных: {err}")
-        except Exception as e:
-            logging.exception(f"Ошибка в parse_and_insert: {e}")
+            logging.error(f"Не удалось проверить индексы orderstable: {err}. Повтор через 20 секунд.")
+            time.sleep(20)
+
+    # Без уникального ключа ON DUPLICATE KEY UPDATE дублировал бы страницу при каждом опросе.
+    if not unique_key:
+        logging.error("В orderstable нет уникального индекса по partner_order_id, запись остановлена. Выполните orderstable_unique.sql.")
+        return
+
+    fingerprints = FingerprintCache()
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cursor:
+                fingerprints.warm(cursor)
+        logging.info(f"Кэш отпечатков заказов загружен: {len(fingerprints)} записей.")
+    except mysql.connector.Error as err:
+        logging.error(f"Не удалось загрузить кэш отпечатков заказов: {err}")
 
-        time.sleep(interval)
+    committed_checkpoints = load_checkpoints()
+
+    while True:
+        page = pages.get()
+        QUEUE_DEPTH.set(pages.qsize())
+
+        while True:
+            try:
+                rows, unchanged = fingerprints.split_changed(page.rows)
+
+                if rows:
+                    with DB_WRITE_SECONDS.time(mode=CUSTOMERS_REFRESH), get_connection() as conn:
+                        with conn.cursor() as cursor:
+                            if CUSTOMERS_REFRESH == "batch":
+                                with bulk_ingest(cursor):
+                                    touched_customers = set()
+                                    added, updated = upsert_orders(cursor, rows, touched_customers=touched_customers, guarded=page.guarded)
+                                    refresh_customers(cursor, touched_customers)
+                                    conn.commit()
+                            else:
+                                added, updated = upsert_orders(cursor, rows, guarded=page.guarded)
+                                conn.commit()
+                    # После записи с проверкой в БД могла остаться более новая версия,
+                    # поэтому отпечатки и задержка учитываются только для обычных страниц.
+                    if not page.guarded:
+                        fingerprints.remember(rows)
+                        observe_freshness(rows)
+                    if poller is not None:
+                        poller.record(len(rows))
+                else:
+                    added, updated = 0, 0
+
+                ORDER_ROWS.inc(added, result="added")
+                ORDER_ROWS.inc(updated, result="updated")
+                ORDER_ROWS.inc(unchanged, result="unchanged")
+
+                logging.info(f"Добавлено записей: {added}, Обновлено записей: {updated}, Без изменений: {unchanged}")
+
+                if page.checkpoints:
+                    committed_checkpoints.update(page.checkpoints)
+                    save_checkpoints(committed_checkpoints)
+
+            except TRANSIENT_DB_ERRORS as err:
+                # Страницу не теряем: контрольная точка сдвигается только после записи.
+                logging.error(f"Ошибка при работе с базой данных: {err}. Повтор через 20 секунд.")
+                DB_RETRIES.inc()
+                time.sleep(20)
+                continue
+            except Exception as e:
+                # Повтор не поможет, а очередь встала бы. В режиме latest те же заказы придут
+                # при следующем опросе; в остальных курсор уже ушёл дальше, и страница
+                # сохраняется в DEAD_LETTER_FILE.
+                ORDER_ROWS.inc(len(page.rows), result="dropped")
+                if SYNC_MODE == "latest" and not page.guarded:
+                    logging.exception(f"Ошибка в parse_and_insert: {e}. Страница пропущена.")
+                else:
+                    logging.exception(f"Ошибка в parse_and_insert: {e}. Страница сохранена в {DEAD_LETTER_FILE}.")
+                    dead_letter_page(page, e)
+            break
+
+        pages.task_done()
 
 if __name__ == "__main__":
 
-    output_file = "data.json"
+    metrics.start(METRICS_PORT)
+
+    pages = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    session = create_session()
+    tokens = TokenManager(session)
+    # Интервал опроса сокращается, пока поток записи находит новые или изменённые заказы.
+    poller = AdaptivePoller()
+
+    # Сырые страницы ответов сохраняются для отладки и повторной записи (python archive.py replay).
+    archive = ResponseArchive(ARCHIVE_DIR) if ARCHIVE_DIR else None
 
-    thread_get_data = threading.Thread(target=get_data, args=(output_file,), daemon=True)
-    thread_parser = threading.Thread(target=parse_and_insert, args=(output_file, 20), daemon=True)
+    thread_get_data = threading.Thread(target=get_data, args=(pages, session, tokens, poller, archive), daemon=True)
+    thread_parser = threading.Thread(target=parse_and_insert, args=(pages, poller), daemon=True)
 
     thread_get_data.start()
     thread_parser.start()
@@ -348,5 +872,8 @@ if __name__ == "__main__":
     try:
         while True:
             time.sleep(1)
+            if not thread_parser.is_alive():
+                logging.error("Поток записи остановлен, завершение работы.")
+                sys.exit(1)
     except KeyboardInterrupt:
         logging.info("Завершение работы по сигналу пользователя.")
\ No newline at end of file
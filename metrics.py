@@ -0,0 +1,278 @@
+"""
+Метрики getorders и getdocs в текстовом формате Prometheus.
+
+Метрики регистрируются в общем реестре процесса и отдаются локальным HTTP-сервером
+по адресу /metrics. При PROFILE_INTERVAL > 0 дополнительно работает выборочный
+профилировщик: раз в PROFILE_INTERVAL секунд он снимает стеки всех потоков,
+накопленные счётчики стеков отдаются по адресу /profile в формате folded stacks
+(подходит для flamegraph.pl и speedscope).
+"""
+import os
+import sys
+import time
+import bisect
+import logging
+import threading
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0"))
+
+# Границы корзин по умолчанию, в секундах: от обращения к БД до медленной загрузки файла.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Общая часть метрик: имя, описание, метки и значения по наборам меток."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames) or any(name not in labels for name in self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        with self._lock:
+            return [(f"{self.name}{self._labels(key)}", value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{sample} {_format_value(value)}" for sample, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счётчики по корзинам (последняя - +Inf), сумма и количество наблюдений.
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока with, в том числе завершившегося исключением."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+
+        samples = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket{self._labels(key, [('le', _format_value(bound))])}", cumulative))
+            samples.append((f"{self.name}_sum{self._labels(key)}", total))
+            samples.append((f"{self.name}_count{self._labels(key)}", count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+class SamplingProfiler:
+    """
+    Выборочный профилировщик на основе sys._current_frames().
+
+    Раз в interval секунд снимает стеки всех потоков, кроме собственного, и считает
+    одинаковые стеки. Потоки не останавливаются, поэтому накладные расходы малы.
+    """
+
+    def __init__(self, interval, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = StackCounter()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            stacks.append(";".join(reversed(stack)))
+
+        with self._lock:
+            self._stacks.update(stacks)
+            self.samples += 1
+
+    def render(self):
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+
+profiler = None
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = REGISTRY.render()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/profile" and profiler is not None:
+            body = profiler.render()
+            content_type = "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start(port, host=METRICS_HOST, profile_interval=PROFILE_INTERVAL):
+    """
+    Запускает HTTP-сервер метрик в фоновом потоке; при port = 0 ничего не делает.
+
+    Возвращает сервер или None.
+    """
+    global profiler
+    if not port:
+        return None
+
+    if profile_interval > 0 and profiler is None:
+        profiler = SamplingProfiler(profile_interval)
+        profiler.start()
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Метрики доступны по адресу http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,125 @@
+import os
+import argparse
+import logging
+
+from db import get_connection
+from getdocs import (
+    BASE_DIR,
+    BLOB_DIR,
+    RECEIPT_HARDLINKS,
+    blob_path,
+    calculate_md5,
+    discard_file,
+    link_receipt,
+    logger,
+)
+
+
+def iter_receipts():
+    """Файлы квитанций в каталогах {customer_code}_receipts, без временных файлов."""
+    for folder in sorted(BASE_DIR.glob("*_receipts")):
+        if not folder.is_dir():
+            continue
+        for path in sorted(folder.iterdir()):
+            if path.is_file() and not path.name.startswith("."):
+                yield path
+
+
+def receipt_order_id(path):
+    """partner_order_id из имени файла {partner_order_id}_receipt.ext или None."""
+    order_id, sep, _ = path.stem.partition("_receipt")
+    return order_id if sep and order_id else None
+
+
+def migrate_file(path, cursor, dry_run, seen, discards):
+    """
+    Переносит один файл в хранилище по хэшу.
+
+    seen - хэши, для которых blob уже есть или был бы создан при --dry-run.
+    Файлы, которые можно удалить после фиксации UPDATE, добавляются в discards.
+    Возвращает количество освобождённых байт (для уже существующего blob).
+    """
+    md5_hash = calculate_md5(path)
+    if not md5_hash:
+        return 0
+
+    blob = blob_path(md5_hash, path.suffix)
+    stat = path.stat()
+
+    # Без жёстких ссылок строку orderdocstable нужно найти по индексу partner_order_id:
+    # receipt_path не индексирован, и поиск по нему просматривал бы таблицу для каждого файла.
+    partner_order_id = receipt_order_id(path)
+    if not RECEIPT_HARDLINKS and partner_order_id is None:
+        logger.warning(f"Не удалось определить partner_order_id по имени файла {path}, файл пропущен.")
+        return 0
+
+    if blob.exists() and os.path.samefile(blob, path):
+        return 0
+
+    saved = 0
+    if not dry_run:
+        if blob.exists():
+            saved = stat.st_size
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            # Новый blob - вторая ссылка на тот же inode, данные не копируются.
+            os.link(path, blob)
+
+        if RECEIPT_HARDLINKS:
+            link_receipt(blob, path)
+        else:
+            cursor.execute(
+                "UPDATE orderdocstable SET receipt_path = %s WHERE partner_order_id = %s AND receipt_path = %s",
+                (str(blob.resolve()), partner_order_id, str(path.resolve()))
+            )
+            # Файл удаляется только после commit: до него orderdocstable ещё ссылается на него.
+            # Если строка не найдена, на файл может ссылаться что-то ещё - он остаётся на месте.
+            if cursor.rowcount > 0:
+                discards.append(path)
+    elif blob.exists() or md5_hash in seen:
+        saved = stat.st_size
+    seen.add(md5_hash)
+
+    return saved
+
+
+def commit_and_discard(cnx, discards):
+    """Фиксирует перенос ссылок в orderdocstable и только затем удаляет старые файлы."""
+    cnx.commit()
+    for path in discards:
+        discard_file(path)
+    discards.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перевод каталогов квитанций в хранилище, адресуемое по MD5.")
+    parser.add_argument("--dry-run", action="store_true", help="только подсчитать экономию, ничего не менять")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    if not args.dry_run:
+        BLOB_DIR.mkdir(parents=True, exist_ok=True)
+
+    files = 0
+    saved = 0
+    seen = set()
+    discards = []
+    with get_connection() as cnx:
+        cursor = cnx.cursor()
+        for path in iter_receipts():
+            try:
+                saved += migrate_file(path, cursor, args.dry_run, seen, discards)
+                files += 1
+            except OSError as e:
+                logger.error(f"Не удалось перенести {path}: {e}")
+            if files % 1000 == 0:
+                commit_and_discard(cnx, discards)
+                logging.info(f"Обработано файлов: {files}, освобождено байт: {saved}")
+        commit_and_discard(cnx, discards)
+        cursor.close()
+
+    logging.info(f"Миграция завершена. Файлов: {files}, освобождено байт: {saved}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+-- Уникальный ключ по orderstable.partner_order_id. Без него INSERT ... ON DUPLICATE KEY UPDATE
+-- в getorders.py (и перенос в backfill.py) добавлял бы копию каждого заказа при каждом опросе,
+-- поэтому getorders.py не запускает запись, пока ключа нет.
+--
+-- Выполнять при остановленном getorders.py. Скрипт повторно выполнять не нужно:
+-- если ключ уже есть, ALTER TABLE завершится ошибкой о дублирующемся имени индекса.
+
+-- 1. Дубликаты: для каждого partner_order_id остаётся версия с наибольшим updated_at.
+CREATE TEMPORARY TABLE orderstable_keep LIKE orderstable;
+ALTER TABLE orderstable_keep ADD UNIQUE KEY uq_orderstable_keep_partner_order (partner_order_id);
+
+-- INSERT IGNORE оставляет первую строку по порядку сортировки, то есть самую свежую.
+INSERT IGNORE INTO orderstable_keep
+SELECT o.*
+FROM orderstable o
+JOIN (
+    SELECT partner_order_id FROM orderstable GROUP BY partner_order_id HAVING COUNT(*) > 1
+) d ON d.partner_order_id = o.partner_order_id
+ORDER BY o.partner_order_id, o.updated_at DESC;
+
+-- Триггеры customers на время замены строк отключены, агрегаты пересчитываются в шаге 3.
+SET @orders_bulk_ingest = 1;
+DELETE FROM orderstable WHERE partner_order_id IN (SELECT partner_order_id FROM orderstable_keep);
+INSERT INTO orderstable SELECT * FROM orderstable_keep;
+SET @orders_bulk_ingest = 0;
+
+-- Повторная вставка запускает orderstable_AFTER_INSERT_pendingdocs; если триггер создан
+-- старой версией pendingdocs.sql, он ставит в очередь и заказы с уже скачанной квитанцией.
+DELETE p FROM pendingdocs p
+JOIN orderstable_keep k ON k.partner_order_id = p.partner_order_id
+WHERE EXISTS (SELECT 1 FROM orderdocstable d WHERE d.partner_order_id = p.partner_order_id);
+
+DROP TEMPORARY TABLE orderstable_keep;
+
+-- 2. Ключ, на который опираются upsert_orders и backfill.py.
+ALTER TABLE orderstable ADD UNIQUE KEY uq_orderstable_partner_order (partner_order_id);
+
+-- 3. Если дубликаты были, повторно выполните INSERT ... SELECT ... GROUP BY
+-- из triggerforcustomers.sql: счётчики customers учитывали каждую копию заказа.
@@ -0,0 +1,74 @@
+-- Очередь заказов, для которых ещё не скачана квитанция. Её наполняют триггеры
+-- orderstable, а getdocs.py читает пачками по первичному ключу и удаляет строку
+-- в той же транзакции, в которой добавляет запись в orderdocstable.
+-- Тип partner_order_id должен совпадать с orderstable.partner_order_id.
+--
+-- Неудачные загрузки остаются в очереди: attempts растёт, next_attempt_at сдвигается
+-- с экспоненциальной задержкой, а после RETRY_MAX_ATTEMPTS попыток state = 'dead'.
+-- Индекс idx_pendingdocs_due работает как очередь с приоритетом по времени следующей попытки.
+--
+-- Экземпляры getdocs забирают строки в аренду (lease_owner, lease_expires_at) через
+-- SELECT ... FOR UPDATE SKIP LOCKED, поэтому нужен MySQL 8.0 или новее.
+CREATE TABLE IF NOT EXISTS pendingdocs (
+    partner_order_id BIGINT NOT NULL,
+    enqueued_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error VARCHAR(1024) NULL,
+    state ENUM('pending', 'dead') NOT NULL DEFAULT 'pending',
+    lease_owner VARCHAR(128) NULL,
+    lease_expires_at DATETIME NULL,
+    PRIMARY KEY (partner_order_id),
+    INDEX idx_pendingdocs_due (state, next_attempt_at)
+);
+
+-- Для таблицы, созданной предыдущей версией скрипта:
+-- ALTER TABLE pendingdocs
+--     ADD COLUMN attempts INT NOT NULL DEFAULT 0,
+--     ADD COLUMN next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+--     ADD COLUMN last_error VARCHAR(1024) NULL,
+--     ADD COLUMN state ENUM('pending', 'dead') NOT NULL DEFAULT 'pending',
+--     ADD COLUMN lease_owner VARCHAR(128) NULL,
+--     ADD COLUMN lease_expires_at DATETIME NULL,
+--     ADD INDEX idx_pendingdocs_due (state, next_attempt_at);
+
+-- Вернуть заказы из dead в работу (например, после починки ссылок):
+-- UPDATE pendingdocs SET state = 'pending', attempts = 0, next_attempt_at = NOW() WHERE state = 'dead';
+
+-- Для проверки наличия квитанции в триггере (пропустите, если индекс уже есть).
+CREATE INDEX idx_orderdocstable_partner_order ON orderdocstable (partner_order_id);
+
+-- Начальное заполнение: все заказы без квитанций.
+INSERT IGNORE INTO pendingdocs (partner_order_id)
+SELECT t.partner_order_id
+FROM orderstable t
+LEFT JOIN orderdocstable k ON t.partner_order_id = k.partner_order_id
+WHERE k.partner_order_id IS NULL;
+
+
+DROP TRIGGER IF EXISTS `orderstable_AFTER_INSERT_pendingdocs`;
+DROP TRIGGER IF EXISTS `orderstable_AFTER_UPDATE_pendingdocs`;
+
+DELIMITER //
+
+CREATE TRIGGER `orderstable_AFTER_INSERT_pendingdocs` AFTER INSERT ON `orderstable` FOR EACH ROW
+BEGIN
+    -- Строка может вставляться повторно (например, orderstable_unique.sql удаляет и
+    -- заново вставляет дубликаты): заказ с уже скачанной квитанцией в очередь не попадает.
+    IF NOT EXISTS (SELECT 1 FROM orderdocstable WHERE partner_order_id = NEW.partner_order_id) THEN
+        INSERT IGNORE INTO pendingdocs (partner_order_id) VALUES (NEW.partner_order_id);
+    END IF;
+END //
+
+CREATE TRIGGER `orderstable_AFTER_UPDATE_pendingdocs` AFTER UPDATE ON `orderstable` FOR EACH ROW
+BEGIN
+    -- Ссылка на квитанцию появилась или сменилась, а квитанция ещё не скачана:
+    -- по новой ссылке попытки начинаются заново.
+    IF NOT (OLD.document_url <=> NEW.document_url)
+       AND NOT EXISTS (SELECT 1 FROM orderdocstable WHERE partner_order_id = NEW.partner_order_id) THEN
+        INSERT INTO pendingdocs (partner_order_id) VALUES (NEW.partner_order_id)
+        ON DUPLICATE KEY UPDATE state = 'pending', attempts = 0, next_attempt_at = NOW(), last_error = NULL;
+    END IF;
+END //
+
+DELIMITER ;
@@ -0,0 +1,103 @@
+"""
+Адаптивный интервал опроса для getorders и getdocs.
+
+Пока циклы находят новые или изменённые заказы (квитанции в очереди), опрос идёт
+с минимальным интервалом; в простое интервал растёт в POLL_BACKOFF раз за цикл
+до POLL_MAX_INTERVAL. Ответы 429/503 с Retry-After откладывают следующий запрос
+не меньше чем на указанное сервером время.
+"""
+import os
+import time
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "5"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "120"))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", "2"))
+
+# Коды ответа, которыми сервер просит снизить частоту запросов.
+THROTTLE_STATUSES = (429, 503)
+
+
+def retry_after_seconds(response):
+    """Задержка из заголовка Retry-After (секунды или HTTP-дата) или None."""
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class AdaptivePoller:
+    """
+    Интервал между циклами опроса, общий для потоков одного процесса.
+
+    record() вызывают те, кто находит изменения, wait() - цикл опроса в конце итерации.
+    Изменения, найденные во время ожидания, прерывают его досрочно.
+    """
+
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL, backoff=POLL_BACKOFF):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+        self._changes = 0
+        self._not_before = 0.0
+        self._cond = threading.Condition()
+
+    def record(self, changes):
+        """Учитывает найденные изменения: следующий цикл начнётся через минимальный интервал."""
+        if changes <= 0:
+            return
+        with self._cond:
+            self._changes += changes
+            self.interval = self.min_interval
+            self._cond.notify_all()
+
+    def throttle(self, retry_after=None):
+        """Сервер просит подождать: без Retry-After интервал увеличивается как в простое."""
+        with self._cond:
+            if retry_after is None:
+                self.interval = min(self.max_interval, self.interval * self.backoff)
+                retry_after = self.interval
+            self._not_before = max(self._not_before, time.monotonic() + retry_after)
+            self._cond.notify_all()
+
+    def hold(self):
+        """Ждёт только окончания паузы, запрошенной сервером (для догрузки следующих страниц)."""
+        with self._cond:
+            while True:
+                remaining = self._not_before - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._cond.wait(remaining)
+
+    def wait(self):
+        """Ждёт начала следующего цикла. Возвращает фактическое время ожидания в секундах."""
+        with self._cond:
+            if self._changes == 0:
+                self.interval = min(self.max_interval, self.interval * self.backoff)
+            self._changes = 0
+
+            started = time.monotonic()
+            while True:
+                deadline = max(started + self.interval, self._not_before)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return time.monotonic() - started
+                self._cond.wait(remaining)
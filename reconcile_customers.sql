@@ -0,0 +1,65 @@
+-- Сверка таблицы customers, которую инкрементально ведут триггеры, с полным
+-- пересчётом по orderstable (тот же GROUP BY, что и в triggerforcustomers.sql).
+-- Выводит клиентов, у которых хотя бы одно значение расходится. Пустой результат - всё сходится.
+
+SELECT
+    COALESCE(c.customer_code, g.customer_code) AS customer_code,
+    c.total_orders, g.total_orders AS expected_total_orders,
+    c.completed_orders, g.completed_orders AS expected_completed_orders,
+    c.last_order, g.last_order AS expected_last_order,
+    c.lastcompleted_order, g.lastcompleted_order AS expected_lastcompleted_order,
+    c.minamount, g.minamount AS expected_minamount,
+    c.maxamount, g.maxamount AS expected_maxamount,
+    c.avgamount, g.avgamount AS expected_avgamount,
+    c.amount_count, g.amount_count AS expected_amount_count,
+    c.amount_sum, g.amount_sum AS expected_amount_sum
+FROM customers c
+LEFT JOIN (
+    SELECT
+        customer_code,
+        SUM(CASE WHEN status = 1 THEN 1 ELSE 0 END) AS completed_orders,
+        COUNT(*) AS total_orders,
+        MAX(CASE WHEN status = 1 THEN updated_at ELSE NULL END) AS lastcompleted_order,
+        MAX(created_at) AS last_order,
+        MIN(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS minamount,
+        MAX(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS maxamount,
+        AVG(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS avgamount,
+        COUNT(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS amount_count,
+        COALESCE(SUM(CASE WHEN status = 1 THEN payment_amount ELSE NULL END), 0) AS amount_sum
+    FROM orderstable
+    GROUP BY customer_code
+) g ON g.customer_code = c.customer_code
+WHERE g.customer_code IS NULL AND c.total_orders <> 0
+   OR g.customer_code IS NOT NULL AND NOT (
+        c.total_orders <=> g.total_orders
+        AND c.completed_orders <=> g.completed_orders
+        AND c.last_order <=> g.last_order
+        AND c.lastcompleted_order <=> g.lastcompleted_order
+        AND c.minamount <=> g.minamount
+        AND c.maxamount <=> g.maxamount
+        AND c.amount_count <=> g.amount_count
+        AND c.amount_sum <=> g.amount_sum
+        AND (c.avgamount <=> g.avgamount OR ABS(c.avgamount - g.avgamount) < 0.01)
+   )
+
+UNION ALL
+
+-- Клиенты, у которых есть заказы, но нет строки в customers.
+SELECT
+    o.customer_code,
+    NULL, COUNT(*),
+    NULL, NULL,
+    NULL, NULL,
+    NULL, NULL,
+    NULL, NULL,
+    NULL, NULL,
+    NULL, NULL,
+    NULL, NULL,
+    NULL, NULL
+FROM orderstable o
+LEFT JOIN customers c ON c.customer_code = o.customer_code
+WHERE c.customer_code IS NULL
+GROUP BY o.customer_code;
+
+-- Для исправления расхождений повторно выполните INSERT ... SELECT ... GROUP BY
+-- из triggerforcustomers.sql: он пересчитывает все строки customers.
@@ -0,0 +1,263 @@
+"""
+Проверка целостности скачанных квитанций.
+
+Обходит orderdocstable пачками по partner_order_id и сверяет MD5 файлов с md5_hash.
+Хэши считаются в пуле процессов; в кэше SQLite хранятся размер, mtime и MD5 уже
+проверенных файлов, поэтому при повторном запуске хэшируются только новые и
+изменённые файлы. Отсутствующие и повреждённые квитанции удаляются из orderdocstable
+и возвращаются в очередь pendingdocs на повторное скачивание.
+
+Чтобы не мешать getdocs, число процессов, скорость чтения (--max-mbps) и приоритет
+(--nice) ограничены. Прерванная проверка продолжается с последней пачки.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import mysql.connector
+
+from db import get_connection
+from getdocs import blob_path, discard_file, logger
+
+SCRUB_CACHE = os.getenv("SCRUB_CACHE", "scrub_cache.sqlite")
+READ_CHUNK_SIZE = 1024 * 1024
+
+REQUEUE_QUERY = """
+INSERT INTO pendingdocs (partner_order_id, last_error) VALUES (%s, %s)
+ON DUPLICATE KEY UPDATE state = 'pending', attempts = 0, next_attempt_at = NOW(),
+    last_error = VALUES(last_error), lease_owner = NULL, lease_expires_at = NULL
+"""
+
+
+def init_worker(nice):
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+
+
+def hash_file(path, bytes_per_sec):
+    """
+    MD5 файла с ограничением скорости чтения.
+
+    Возвращает (путь, размер, mtime_ns, MD5 или None, текст ошибки или None).
+    """
+    try:
+        stat = os.stat(path)
+        hash_md5 = hashlib.md5()
+        started = time.monotonic()
+        read = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+                hash_md5.update(chunk)
+                read += len(chunk)
+                if bytes_per_sec:
+                    ahead = read / bytes_per_sec - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        return path, stat.st_size, stat.st_mtime_ns, hash_md5.hexdigest(), None
+    except FileNotFoundError:
+        return path, None, None, None, "missing"
+    except OSError as e:
+        return path, None, None, None, str(e)
+
+
+class ScrubCache:
+    """Кэш SQLite: проверенные файлы (размер, mtime, MD5) и место остановки обхода."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS progress (id INTEGER PRIMARY KEY CHECK (id = 1), last_id INTEGER)")
+
+    def lookup(self, path, stat):
+        """MD5 из кэша, если размер и mtime файла не изменились."""
+        row = self.db.execute("SELECT size, mtime_ns, md5 FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        return None
+
+    def store(self, path, size, mtime_ns, md5_hash):
+        self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, md5) VALUES (?, ?, ?, ?)", (path, size, mtime_ns, md5_hash))
+
+    def forget(self, path):
+        self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def last_id(self):
+        row = self.db.execute("SELECT last_id FROM progress WHERE id = 1").fetchone()
+        return row[0] if row else 0
+
+    def save_progress(self, last_id):
+        self.db.execute("INSERT OR REPLACE INTO progress (id, last_id) VALUES (1, ?)", (last_id,))
+        self.db.commit()
+
+
+def fetch_batch(last_id, batch_size):
+    with get_connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute(
+            """
+            SELECT partner_order_id, receipt_path, md5_hash
+            FROM orderdocstable
+            WHERE partner_order_id > %s
+            ORDER BY partner_order_id
+            LIMIT %s
+            """,
+            (last_id, batch_size)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
+
+def discard_corrupted(path, md5_hash):
+    """
+    Удаляет повреждённый файл, чтобы getdocs скачал его заново.
+
+    Если файл - жёсткая ссылка на blob в хранилище по MD5, удаляется и blob:
+    иначе при повторной загрузке getdocs принял бы испорченный blob за готовую копию.
+    """
+    path = Path(path)
+    blob = blob_path(md5_hash, path.suffix)
+    try:
+        if blob != path and blob.exists() and os.path.samefile(blob, path):
+            discard_file(blob)
+    except OSError:
+        pass
+    discard_file(path)
+
+
+def requeue(problems):
+    """Удаляет записи orderdocstable и возвращает заказы в pendingdocs одной транзакцией."""
+    requeued = 0
+    with get_connection() as cnx:
+        cursor = cnx.cursor()
+        for partner_order_id, receipt_path, md5_hash, reason in problems:
+            cursor.execute(
+                "DELETE FROM orderdocstable WHERE partner_order_id = %s AND receipt_path <=> %s",
+                (partner_order_id, receipt_path)
+            )
+            if cursor.rowcount == 0:
+                continue
+            cursor.execute(REQUEUE_QUERY, (partner_order_id, f"scrub: {reason}"))
+            requeued += 1
+        cnx.commit()
+        cursor.close()
+
+    # Файлы удаляются только после фиксации: до неё getdocs не начнёт повторную загрузку.
+    for partner_order_id, receipt_path, md5_hash, reason in problems:
+        if reason == "mismatch" and receipt_path:
+            discard_corrupted(receipt_path, md5_hash)
+    return requeued
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка MD5 скачанных квитанций и повторная загрузка повреждённых.")
+    parser.add_argument("--workers", type=int, default=2, help="процессов для подсчёта MD5")
+    parser.add_argument("--max-mbps", type=float, default=20, help="общий предел скорости чтения, МБ/с (0 - без ограничения)")
+    parser.add_argument("--nice", type=int, default=10, help="понижение приоритета процессов проверки")
+    parser.add_argument("--batch-size", type=int, default=1000, help="строк orderdocstable за один запрос")
+    parser.add_argument("--cache", default=SCRUB_CACHE, help="файл кэша SQLite")
+    parser.add_argument("--restart", action="store_true", help="начать обход сначала, а не с места остановки")
+    parser.add_argument("--dry-run", action="store_true", help="только сообщить о проблемах, ничего не менять")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    cache = ScrubCache(args.cache)
+    last_id = 0 if args.restart else cache.last_id()
+    if last_id:
+        logging.info(f"Продолжение проверки после partner_order_id={last_id}")
+
+    bytes_per_sec = args.max_mbps * 1024 * 1024 / args.workers if args.max_mbps > 0 else 0
+    checked = hashed = hashed_bytes = 0
+    found = {"missing": 0, "mismatch": 0, "error": 0}
+    requeued = 0
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.nice,)) as pool:
+            while True:
+                rows = fetch_batch(last_id, args.batch_size)
+                if not rows:
+                    break
+
+                problems = []
+                expected = {}
+                for partner_order_id, receipt_path, md5_hash in rows:
+                    expected.setdefault(receipt_path, []).append((partner_order_id, md5_hash))
+
+                # Файлы с неизменными размером и mtime не перечитываются.
+                actual = {}
+                to_hash = []
+                for receipt_path in expected:
+                    if not receipt_path:
+                        actual[receipt_path] = (None, "missing")
+                        continue
+                    try:
+                        cached = cache.lookup(receipt_path, os.stat(receipt_path))
+                    except OSError:
+                        cached = None
+                    if cached:
+                        actual[receipt_path] = (cached, None)
+                    else:
+                        to_hash.append(receipt_path)
+
+                for path, size, mtime_ns, md5_hash, error in pool.map(hash_file, to_hash, [bytes_per_sec] * len(to_hash), chunksize=8):
+                    if error:
+                        cache.forget(path)
+                        actual[path] = (None, error)
+                        continue
+                    cache.store(path, size, mtime_ns, md5_hash)
+                    actual[path] = (md5_hash, None)
+                    hashed += 1
+                    hashed_bytes += size
+
+                for receipt_path, orders in expected.items():
+                    file_md5, error = actual[receipt_path]
+                    for partner_order_id, md5_hash in orders:
+                        checked += 1
+                        if error == "missing":
+                            reason = "missing"
+                        elif error:
+                            # Ошибка чтения (например, нет доступа): повторная загрузка не поможет.
+                            found["error"] += 1
+                            logger.error(f"Не удалось проверить квитанцию {receipt_path} (partner_order_id={partner_order_id}): {error}")
+                            continue
+                        elif not md5_hash or file_md5 == md5_hash:
+                            # Совпадает, или MD5 не был сохранён при скачивании и сверять не с чем.
+                            continue
+                        else:
+                            reason = "mismatch"
+                        found[reason] += 1
+                        logger.warning(f"Квитанция {receipt_path} (partner_order_id={partner_order_id}): {reason}")
+                        problems.append((partner_order_id, receipt_path, md5_hash, reason))
+
+                if problems and not args.dry_run:
+                    requeued += requeue(problems)
+                    for _, receipt_path, _, _ in problems:
+                        cache.forget(receipt_path)
+
+                last_id = rows[-1][0]
+                if not args.dry_run:
+                    cache.save_progress(last_id)
+                logging.info(f"Проверено: {checked}, прочитано файлов: {hashed} ({hashed_bytes // (1024 * 1024)} МБ), "
+                             f"нет файла: {found['missing']}, MD5 не совпадает: {found['mismatch']}, ошибок: {found['error']}")
+
+        # Обход завершён, следующий запуск начнётся сначала.
+        if not args.dry_run:
+            cache.save_progress(0)
+    except mysql.connector.Error as err:
+        logging.error(f"Ошибка при работе с базой данных: {err}. Следующий запуск продолжит с partner_order_id={last_id}.")
+    finally:
+        cache.db.commit()
+        cache.db.close()
+
+    logging.info(f"Проверка завершена. Проверено: {checked}, возвращено в очередь: {requeued}, "
+                 f"нет файла: {found['missing']}, MD5 не совпадает: {found['mismatch']}, ошибок: {found['error']}")
+
+
+if __name__ == "__main__":
+    main()
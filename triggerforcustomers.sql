@@ -1,59 +1,161 @@
-INSERT INTO customers (customer_code, completed_orders, total_orders, lastcompleted_order, last_order, minamount, maxamount, avgamount)
-SELECT
-    customer_code,
-    SUM(CASE WHEN status = 1 THEN 1 ELSE 0 END) AS completed_orders,
-    COUNT(*) AS total_orders,
-    MAX(CASE WHEN status = 1 THEN updated_at ELSE NULL END) AS lastcompleted_order,
-    MAX(created_at) AS last_order,
-    MIN(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS minamount,
-    MAX(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS maxamount,
-    AVG(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS avgamount
-FROM orderstable
-GROUP BY customer_code;
-
-
-DELIMITER //
-
-CREATE TRIGGER `orderstable_AFTER_INSERT` AFTER INSERT ON `orderstable` FOR EACH ROW
-BEGIN
-    INSERT INTO customers (customer_code, completed_orders, total_orders, lastcompleted_order, last_order, minamount, maxamount, avgamount)
-    SELECT
-        NEW.customer_code,
-        SUM(CASE WHEN status = 1 THEN 1 ELSE 0 END) AS completed_orders,
-        COUNT(*) AS total_orders,
-        MAX(CASE WHEN status = 1 THEN updated_at ELSE NULL END) AS lastcompleted_order,
-        MAX(created_at) AS last_order,
-        MIN(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS minamount,
-        MAX(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS maxamount,
-        AVG(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS avgamount
-    FROM orderstable
-    WHERE customer_code = NEW.customer_code
-    ON DUPLICATE KEY UPDATE
-        completed_orders = VALUES(completed_orders),
-        total_orders = VALUES(total_orders),
-        lastcompleted_order = VALUES(lastcompleted_order),
-        last_order = VALUES(last_order),
-        minamount = VALUES(minamount),
-        maxamount = VALUES(maxamount),
-        avgamount = VALUES(avgamount);
-END //
-DELIMITER ;
-
-
-DELIMITER //
-CREATE TRIGGER `orderstable_AFTER_UPDATE` AFTER UPDATE ON `orderstable` FOR EACH ROW
-BEGIN
-    UPDATE customers
-    SET
-        total_orders = (SELECT COUNT(*) FROM orderstable WHERE customer_code = NEW.customer_code),
-        last_order = (SELECT MAX(created_at) FROM orderstable WHERE customer_code = NEW.customer_code),
-        completed_orders = (SELECT COUNT(*) FROM orderstable WHERE customer_code = NEW.customer_code AND status = 1),
-        lastcompleted_order = (SELECT MAX(updated_at) FROM orderstable WHERE customer_code = NEW.customer_code AND status = 1),
-        minamount = (SELECT MIN(payment_amount) FROM orderstable WHERE customer_code = NEW.customer_code AND status = 1),
-        maxamount = (SELECT MAX(payment_amount) FROM orderstable WHERE customer_code = NEW.customer_code AND status = 1),
-        avgamount = (SELECT AVG(payment_amount) FROM orderstable WHERE customer_code = NEW.customer_code AND status = 1)
-    WHERE customer_code = NEW.customer_code;
-END //
-
-
-DELIMITER ;
+-- Счётчики для инкрементального расчёта средней суммы: avgamount = amount_sum / amount_count
+-- по подтверждённым заказам с заполненной суммой.
+ALTER TABLE customers
+    ADD COLUMN amount_count INT NOT NULL DEFAULT 0,
+    ADD COLUMN amount_sum DECIMAL(20, 2) NOT NULL DEFAULT 0;
+
+-- Индексы для точечного пересчёта границ (min/max) одного клиента без просмотра всей его истории.
+CREATE INDEX idx_orderstable_customer_created ON orderstable (customer_code, created_at);
+CREATE INDEX idx_orderstable_customer_status_updated ON orderstable (customer_code, status, updated_at);
+CREATE INDEX idx_orderstable_customer_status_amount ON orderstable (customer_code, status, payment_amount);
+
+
+INSERT INTO customers (customer_code, completed_orders, total_orders, lastcompleted_order, last_order, minamount, maxamount, avgamount, amount_count, amount_sum)
+SELECT
+    customer_code,
+    SUM(CASE WHEN status = 1 THEN 1 ELSE 0 END) AS completed_orders,
+    COUNT(*) AS total_orders,
+    MAX(CASE WHEN status = 1 THEN updated_at ELSE NULL END) AS lastcompleted_order,
+    MAX(created_at) AS last_order,
+    MIN(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS minamount,
+    MAX(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS maxamount,
+    AVG(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS avgamount,
+    COUNT(CASE WHEN status = 1 THEN payment_amount ELSE NULL END) AS amount_count,
+    COALESCE(SUM(CASE WHEN status = 1 THEN payment_amount ELSE NULL END), 0) AS amount_sum
+FROM orderstable
+GROUP BY customer_code
+ON DUPLICATE KEY UPDATE
+    completed_orders = VALUES(completed_orders),
+    total_orders = VALUES(total_orders),
+    lastcompleted_order = VALUES(lastcompleted_order),
+    last_order = VALUES(last_order),
+    minamount = VALUES(minamount),
+    maxamount = VALUES(maxamount),
+    avgamount = VALUES(avgamount),
+    amount_count = VALUES(amount_count),
+    amount_sum = VALUES(amount_sum);
+
+
+DROP TRIGGER IF EXISTS `orderstable_AFTER_INSERT`;
+DROP TRIGGER IF EXISTS `orderstable_AFTER_UPDATE`;
+DROP TRIGGER IF EXISTS `orderstable_AFTER_DELETE`;
+DROP PROCEDURE IF EXISTS `customers_add_order`;
+DROP PROCEDURE IF EXISTS `customers_remove_order`;
+
+
+DELIMITER //
+
+-- Добавляет вклад одного заказа в агрегаты клиента.
+CREATE PROCEDURE `customers_add_order`(
+    IN p_customer_code VARCHAR(255),
+    IN p_status INT,
+    IN p_payment_amount DECIMAL(20, 2),
+    IN p_created_at DATETIME,
+    IN p_updated_at DATETIME
+)
+BEGIN
+    INSERT INTO customers (customer_code, completed_orders, total_orders, lastcompleted_order, last_order, minamount, maxamount, avgamount, amount_count, amount_sum)
+    VALUES (
+        p_customer_code,
+        IF(p_status = 1, 1, 0),
+        1,
+        IF(p_status = 1, p_updated_at, NULL),
+        p_created_at,
+        IF(p_status = 1, p_payment_amount, NULL),
+        IF(p_status = 1, p_payment_amount, NULL),
+        IF(p_status = 1, p_payment_amount, NULL),
+        IF(p_status = 1 AND p_payment_amount IS NOT NULL, 1, 0),
+        IF(p_status = 1 AND p_payment_amount IS NOT NULL, p_payment_amount, 0)
+    )
+    ON DUPLICATE KEY UPDATE
+        completed_orders = completed_orders + VALUES(completed_orders),
+        total_orders = total_orders + 1,
+        lastcompleted_order = GREATEST(COALESCE(lastcompleted_order, VALUES(lastcompleted_order)), COALESCE(VALUES(lastcompleted_order), lastcompleted_order)),
+        last_order = GREATEST(COALESCE(last_order, VALUES(last_order)), COALESCE(VALUES(last_order), last_order)),
+        minamount = LEAST(COALESCE(minamount, VALUES(minamount)), COALESCE(VALUES(minamount), minamount)),
+        maxamount = GREATEST(COALESCE(maxamount, VALUES(maxamount)), COALESCE(VALUES(maxamount), maxamount)),
+        amount_count = amount_count + VALUES(amount_count),
+        amount_sum = amount_sum + VALUES(amount_sum),
+        avgamount = IF(amount_count > 0, amount_sum / amount_count, NULL);
+END //
+
+-- Убирает вклад одного заказа из агрегатов клиента. Если заказ был границей
+-- (min/max суммы, последняя дата), пересчитывается только эта граница по индексу.
+CREATE PROCEDURE `customers_remove_order`(
+    IN p_customer_code VARCHAR(255),
+    IN p_status INT,
+    IN p_payment_amount DECIMAL(20, 2),
+    IN p_created_at DATETIME,
+    IN p_updated_at DATETIME
+)
+BEGIN
+    DECLARE v_last_order DATETIME;
+    DECLARE v_lastcompleted_order DATETIME;
+    DECLARE v_minamount DECIMAL(20, 2);
+    DECLARE v_maxamount DECIMAL(20, 2);
+
+    SELECT last_order, lastcompleted_order, minamount, maxamount
+    INTO v_last_order, v_lastcompleted_order, v_minamount, v_maxamount
+    FROM customers
+    WHERE customer_code = p_customer_code
+    FOR UPDATE;
+
+    UPDATE customers
+    SET
+        total_orders = total_orders - 1,
+        completed_orders = completed_orders - IF(p_status = 1, 1, 0),
+        amount_count = amount_count - IF(p_status = 1 AND p_payment_amount IS NOT NULL, 1, 0),
+        amount_sum = amount_sum - IF(p_status = 1 AND p_payment_amount IS NOT NULL, p_payment_amount, 0),
+        avgamount = IF(amount_count > 0, amount_sum / amount_count, NULL)
+    WHERE customer_code = p_customer_code;
+
+    IF p_created_at = v_last_order THEN
+        UPDATE customers
+        SET last_order = (SELECT MAX(created_at) FROM orderstable WHERE customer_code = p_customer_code)
+        WHERE customer_code = p_customer_code;
+    END IF;
+
+    IF p_status = 1 AND p_updated_at = v_lastcompleted_order THEN
+        UPDATE customers
+        SET lastcompleted_order = (SELECT MAX(updated_at) FROM orderstable WHERE customer_code = p_customer_code AND status = 1)
+        WHERE customer_code = p_customer_code;
+    END IF;
+
+    IF p_status = 1 AND (p_payment_amount = v_minamount OR p_payment_amount = v_maxamount) THEN
+        UPDATE customers
+        SET
+            minamount = (SELECT MIN(payment_amount) FROM orderstable WHERE customer_code = p_customer_code AND status = 1),
+            maxamount = (SELECT MAX(payment_amount) FROM orderstable WHERE customer_code = p_customer_code AND status = 1)
+        WHERE customer_code = p_customer_code;
+    END IF;
+END //
+
+CREATE TRIGGER `orderstable_AFTER_INSERT` AFTER INSERT ON `orderstable` FOR EACH ROW
+BEGIN
+    -- В режиме пакетной загрузки (@orders_bulk_ingest = 1) customers пересчитывает загрузчик.
+    IF COALESCE(@orders_bulk_ingest, 0) = 0 THEN
+        CALL customers_add_order(NEW.customer_code, NEW.status, NEW.payment_amount, NEW.created_at, NEW.updated_at);
+    END IF;
+END //
+
+CREATE TRIGGER `orderstable_AFTER_UPDATE` AFTER UPDATE ON `orderstable` FOR EACH ROW
+BEGIN
+    -- Изменения прочих полей заказа на агрегаты клиента не влияют.
+    IF COALESCE(@orders_bulk_ingest, 0) = 0 AND NOT (OLD.customer_code <=> NEW.customer_code
+            AND OLD.status <=> NEW.status
+            AND OLD.payment_amount <=> NEW.payment_amount
+            AND OLD.created_at <=> NEW.created_at
+            AND OLD.updated_at <=> NEW.updated_at) THEN
+        CALL customers_remove_order(OLD.customer_code, OLD.status, OLD.payment_amount, OLD.created_at, OLD.updated_at);
+        CALL customers_add_order(NEW.customer_code, NEW.status, NEW.payment_amount, NEW.created_at, NEW.updated_at);
+    END IF;
+END //
+
+CREATE TRIGGER `orderstable_AFTER_DELETE` AFTER DELETE ON `orderstable` FOR EACH ROW
+BEGIN
+    IF COALESCE(@orders_bulk_ingest, 0) = 0 THEN
+        CALL customers_remove_order(OLD.customer_code, OLD.status, OLD.payment_amount, OLD.created_at, OLD.updated_at);
+    END IF;
+END //
+
+DELIMITER ;